@@ -1,50 +1,150 @@
 import argparse
+import cProfile
+import mmap
+import os
 import re
 import sys
+import time
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
 
 import numpy as np
-from matplotlib import pyplot as plt
-# from scipy.interpolate import interp1d
-# from scipy.optimize import nnls
-# from scipy.stats import linregress
+# matplotlib and scipy.optimize take longer to import than everything else
+# together. They are only imported where figures are drawn and spectra fitted
+# so that scripts and worker processes which only parse and broaden start
+# quickly, see irras_bench.py --imports.
+
+import irras_cache
+import irras_follow
+import irras_timing
+from irras_spectrum import (IR_BLOCK_END, IR_BLOCK_START, BroadenedSpectrum,
+                            StickSpectrum, last_energy, spectrum_from_block)
+
+# Number of grid points broadened at once. Bounds the size of the temporary
+# (points x sticks) matrices for large stick spectra.
+BLOCK_SIZE = 256
+# Minimum number of points per linewidth of the grid used by the FFT engine.
+# The error from binning the sticks onto the grid decreases quadratically
+# with it and is about 1e-3 of the spectrum maximum at the default.
+FFT_POINTS_PER_LW = 10
+# Relative cost of one FFT grid point (times log2 of the grid size) compared to
+# evaluating one Gaussian in the direct engine. Used by choose_engine.
+FFT_COST_FACTOR = 1
+# Available lineshapes and the distance (in units of the linewidth) beyond
+# which a stick no longer contributes to the broadened spectrum. The Lorentzian
+# tails are long and have dropped to about 1e-4 of the maximum at the cutoff.
+LINESHAPES = ("gaussian", "lorentzian", "pseudo-voigt")
+CUTOFFS = {"gaussian": 4, "lorentzian": 100, "pseudo-voigt": 100}
+# Mixing parameter (Lorentzian fraction) of the pseudo-Voigt profile.
+PSEUDO_VOIGT_ETA = 0.5
+# Converts the linewidth (sigma) of a Gaussian into the half width at half
+# maximum of a Lorentzian with the same full width at half maximum.
+HWHM_PER_SIGMA = np.sqrt(2 * np.log(2))
+# Number of sampled kernels kept in memory for the FFT engine.
+KERNEL_CACHE_SIZE = 32
+# Defaults of the peak assignment: minimum prominence of experimental peaks
+# relative to the range of the spectrum, maximum distance in cm**-1 between
+# a peak and the scaled mode assigned to it and minimum T**2 of assigned modes
+# relative to the strongest one, which keeps dark modes out.
+PEAK_PROMINENCE = 0.05
+PEAK_TOLERANCE = 30
+PEAK_MIN_INTENSITY = 0.01
+# Maximum number of alternations between assigning peaks and fitting the
+# scale factor. The assignment usually stops changing after two or three.
+PEAK_MAX_ITERATIONS = 10
+# Boltzmann constant in Hartree per Kelvin.
+BOLTZMANN_HARTREE = 3.166811563e-6
+# First line of the data in column-shaped text files. Anything before it is
+# treated as header.
+EXP_DATA_PATTERN = re.compile(r"^\d")
+# Number of data lines the column separator and decimal mark are guessed
+# from. Single lines are ambiguous, e.g. 4000,0 may be a single number.
+EXP_SAMPLE_LINES = 50
 
 
 def parse_args():
-    parser = argparse.ArgumentParser(description="""
+    parser = argparse.ArgumentParser(parents=[broadening_parser()],
+                                     description="""
         Fits calculated x. y and z components of IR spectrum to experimental
         ones and plot the results. Can also be used for plotting only.""")
-    # capital_group = parser.add_mutually_exclusive_group()
-    # capital_group.add_argument("-P". "--plot". action="store_true".
-    #                            help="Plot Mode")
-    # capital_group.add_argument("-F". "--fit". action="store_true".
-    #                            help="Fit Mode")
-    #
+    parser.add_argument("-F", "--fit", action="store_true",
+                        help="Fit the x-, y- and z-polarized components to "
+                             "the experimental spectrum")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="Optimize scale factor, linewidth and baseline "
+                             "shift against the experimental spectrum")
+    parser.add_argument("-P", "--peaks", action="store_true",
+                        help="Pick the peaks of the experimental spectrum, "
+                             "assign calculated modes to them and use the "
+                             "scale factor fitted to the assigned pairs, "
+                             "starting from the scale factors of --sf-range")
+    parser.add_argument("--tolerance", metavar="", type=float,
+                        default=PEAK_TOLERANCE,
+                        help="Maximum distance in cm**-1 between a peak and "
+                             f"its mode (Default = {PEAK_TOLERANCE})")
+    parser.add_argument("--prominence", metavar="", type=float,
+                        default=PEAK_PROMINENCE,
+                        help="Minimum prominence of peaks relative to the "
+                             "range of the experimental spectrum (Default = "
+                             f"{PEAK_PROMINENCE})")
+    parser.add_argument("--sf-range", metavar="", type=float, nargs=3,
+                        default=[0.9, 1.05, 16],
+                        help="Minimum, maximum and number of scale factors of "
+                             "the optimization grid")
+    parser.add_argument("--lw-range", metavar="", type=float, nargs=3,
+                        default=[5, 30, 11],
+                        help="Minimum, maximum and number of linewidths of "
+                             "the optimization grid")
+    parser.add_argument("-j", "--workers", metavar="", type=int, default=None,
+                        help="Number of processes used for optimizing and "
+                             "parsing ensembles (Default = number of CPUs)")
+    parser.add_argument("-A", "--anglemap", action="store_true",
+                        help="Plot the IRRAS spectrum as function of the "
+                             "molecular tilt angle and fit the orientation to "
+                             "the experimental spectrum if given")
+    parser.add_argument("--theta-step", metavar="", type=float, default=5,
+                        help="Step of the tilt angle in degrees")
+    parser.add_argument("--phi-step", metavar="", type=float, default=15,
+                        help="Step of the azimuthal angle in degrees")
     parser.add_argument("-o", "--outfile", metavar="",
                         help="Name of the ORCA output file")
+    parser.add_argument("-f", "--follow", action="store_true",
+                        help="Follow the ORCA output while the job is still "
+                             "running and plot it once the IR spectrum has "
+                             "been written")
+    parser.add_argument("--interval", metavar="", type=float, default=5,
+                        help="Seconds between checks of the followed ORCA "
+                             "output (Default = 5)")
+    parser.add_argument("-E", "--ensemble", metavar="", nargs="+",
+                        help="ORCA outputs of a conformer ensemble which are "
+                             "averaged with Boltzmann weights instead of "
+                             "using a single output")
+    parser.add_argument("-T", "--temperature", metavar="", type=float,
+                        default=298.15, help="Temperature in K for the "
+                                             "Boltzmann weights of the "
+                                             "ensemble (Default = 298.15)")
     parser.add_argument("-e", "--expfile", metavar="",
                         help="Name of the file containing the experimental "
                              "spectrum")
-    # parser.add_argument("-p". "--paramfile". metavar="".
-    #                     help="Name of the parameter file used for fitting")
-    parser.add_argument("-lw", "--linewidth", metavar="", type=float,
-                        default=15, help="Linewidth used for plotting and "
-                                         "fitting")
-    parser.add_argument("-x0", "--xmin", metavar="", type=float, default=500,
-                        help="Minimum x value for plotting")
-    parser.add_argument("-x1", "--xmax", metavar="", type=float, default=4000,
-                        help="Maximum y value for plotting")
-    parser.add_argument("-n", "--npoints", metavar="", type=float,
-                        default=1024, help="Number of points used for plotting"
-                                           " and fitting.")
     parser.add_argument("-bs", "--baselineshift", metavar="", type=float,
-                        default=None, help="Absolute amount of baseline "
+                        default=0, help="Absolute amount of baseline "
                                            "shifting for experimental "
                                            "spectrum")
-    parser.add_argument("-sf", "--scalefactor", metavar="", type=float,
-                        default=None, help="Scaling factor for the calculated "
-                                           "spectrum which will also be used "
-                                           "for fitting.")
+    parser.add_argument("--cache-dir", metavar="",
+                        default=irras_cache.DEFAULT_CACHE_DIR,
+                        help="Directory for caching parsed spectra "
+                             f"(Default = {irras_cache.DEFAULT_CACHE_DIR})")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always parse the files instead of using the "
+                             "cache")
+    parser.add_argument("--timings", metavar="", nargs="?", const="-",
+                        help="Write the time spent in each stage (read, "
+                             "parse, broaden, normalize, draw) as JSON lines "
+                             "to this file or to stderr if none is given")
+    parser.add_argument("--profile", metavar="",
+                        help="Profile the whole run with cProfile and dump "
+                             "the statistics to this file")
     parser.add_argument("-x", "--plotx", action="store_true",
                         help="Plot x-polarized component of spectrum")
     parser.add_argument("-y", "--ploty", action="store_true",
@@ -56,110 +156,175 @@ def parse_args():
     return parser
 
 
+def positive_float(value):
+    """Argument type of argparse for floats greater than zero.
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a number") from None
+    if not number > 0:
+        raise argparse.ArgumentTypeError(f"{value} is not positive")
+    return number
+
+
+def broadening_parser():
+    """Returns a parser of the options for broadening calculated spectra
+    which all scripts share. It is meant as parent of their parsers.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-lw", "--linewidth", metavar="", type=positive_float,
+                        default=15, help="Linewidth used for broadening "
+                                         "(Default = 15)")
+    parser.add_argument("-x0", "--xmin", metavar="", type=float, default=500,
+                        help="Minimum x value (Default = 500)")
+    parser.add_argument("-x1", "--xmax", metavar="", type=float, default=4000,
+                        help="Maximum x value (Default = 4000)")
+    parser.add_argument("-n", "--npoints", metavar="", type=int, default=1024,
+                        help="Number of points of the calculated spectra "
+                             "(Default = 1024)")
+    parser.add_argument("-sf", "--scalefactor", metavar="", type=float,
+                        default=1, help="Scaling factor for the calculated "
+                                        "spectra (Default = 1)")
+    parser.add_argument("-ls", "--lineshape", metavar="", default="gaussian",
+                        choices=LINESHAPES,
+                        help="Lineshape used for broadening: gaussian, "
+                             "lorentzian or pseudo-voigt (Default = gaussian)")
+    parser.add_argument("--engine", metavar="", default="auto",
+                        choices=["auto", "direct", "fft"],
+                        help="Broadening engine: direct, fft or auto "
+                             "(Default = auto)")
+    return parser
+
+
 def parse_outfile(outfile, scalefactor=1):
-    """ This parses ORCA output (currently 5.0 dev version). Parse variable
-    returns True only between the lines containing 'IR Spectrum' and the next
-    line starting with an asterisk which includes only the IR transitions.
-    Returns the wave number of the transition and T**2. x. y. z polarized
-    values as arrays. Optional scaling factor included as command line arg.
+    """ This parses ORCA output (currently 5.0 dev version). The file is
+    memory-mapped and searched backwards for the last line containing
+    'IR SPECTRUM' so that only that block, which ends with the next line
+    starting with an asterisk, is ever read. Returns a StickSpectrum with the
+    wave numbers of the transitions, T**2, the x, y, z polarized values and
+    the signed transition dipoles (TX, TY, TZ) as well as the final single
+    point energy in Hartree (NaN if there is none). Optional scaling factor
+    included as command line arg.
     """
     try:
-        with open(f"{outfile}", "r") as f:
-            f_lines = f.readlines()
+        with irras_timing.stage("read", file=str(outfile)), \
+                open(f"{outfile}", "rb") as f:
+            block = find_ir_block(f)
+            energy = find_energy(f)
     except FileNotFoundError:
         sys.exit("Error! ORCA output file not found or not given! Exiting ...")
 
-    wavenumber = []
-    x = []
-    y = []
-    z = []
-    t_sq = []
-    pattern = re.compile(r"^\s*\d+:")
-    parse = False
-    for line in f_lines:
-        matches = pattern.match(line)
-        if "IR SPECTRUM" in line:
-            parse = True
-        if line.startswith("*"):
-            parse = False
-        if matches is not None and parse:
-            line = line.replace("(", "")
-            line = line.replace(")", "")
-            splitline = re.split(r"\s+", line.strip())
-            wavenumber.append(float(splitline[1]))
-            t_sq.append(float(splitline[4]))
-            x.append(float(splitline[5]) ** 2)
-            y.append(float(splitline[6]) ** 2)
-            z.append(float(splitline[7]) ** 2)
-
-    wavenumber = np.multiply(wavenumber, scalefactor)
-
-    if wavenumber.size == 0 or wavenumber.size != len(z):
+    if block is None:
         raise ValueError("Error! Invalid ORCA output file")
-    else:
-        calc_spectrum = namedtuple("Spectrum", ["wn", "t_sq", "x", "y", "z"])
-        return calc_spectrum(wavenumber, t_sq, x, y, z)
+    with irras_timing.stage("parse", file=str(outfile)):
+        return spectrum_from_block(block, energy, scalefactor)
+
+
+def follow_outfile(outfile, scalefactor=1, interval=5):
+    """Waits for the IR spectrum block of an ORCA output that is still being
+    written and returns its Spectrum like parse_outfile. Every check only
+    reads what was appended since the last one.
+    """
+    if not outfile:
+        sys.exit("Error! ORCA output file not found or not given! Exiting ...")
+    follower = irras_follow.OutfileFollower(outfile, scalefactor)
+    print(f"Waiting for the IR spectrum in {outfile} ...")
+    while True:
+        spectrum = follower.poll()
+        if spectrum is not None:
+            return spectrum
+        if follower.behind:
+            continue
+        if follower.finished:
+            sys.exit("Error! ORCA job finished without an IR spectrum! "
+                     "Exiting ...")
+        time.sleep(interval)
+
+
+def find_ir_block(f):
+    """Returns the bytes of the last IR spectrum block of the ORCA output
+    opened as binary file object f or None if there is none.
+    """
+    try:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        # Empty files and special files such as pipes cannot be mapped.
+        return None
+    with buffer:
+        start = buffer.rfind(IR_BLOCK_START)
+        if start == -1:
+            return None
+        end = buffer.find(IR_BLOCK_END, start)
+        return buffer[start:end if end != -1 else len(buffer)]
+
+
+def find_energy(f):
+    """Returns the last final single point energy in Hartree of the ORCA
+    output opened as binary file object f or NaN if there is none.
+    """
+    try:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        return np.nan
+    with buffer:
+        return last_energy(buffer)
 
 
 def parse_exp(expfile, bls=0):
     """This can be used to parse any column-shaped text file (such as
     experimentally recorded spectra. The function returns the first two
     columns and offers baseline shifting (as optional arg) if desired.
+    The file is only read, in a single pass. Header lines are skipped.
+    Semicolons are accepted as column separator, commas as column separator
+    or decimal separator, the latter if semicolons separate the columns or
+    the first EXP_SAMPLE_LINES lines contain no points. If the numbers cannot
+    be read with decimal commas, commas are tried as separator as well.
     """
     try:
-        with open(expfile, "r") as f:
-            f_lines = f.readlines()
+        with irras_timing.stage("read", file=str(expfile)), \
+                open(expfile, "r") as f:
+            for line in f:
+                if EXP_DATA_PATTERN.match(line):
+                    break
+            else:
+                raise ValueError("Error! Invalid experimental spectrum file")
+            data = line + f.read()
     except FileNotFoundError:
         sys.exit("Error! Experimental spectrum file not found! Exiting ...")
     except TypeError:
         sys.exit("Error! No experimental spectrum file was given! Exiting ...")
 
-    pattern = re.compile(r"^\d")
-    header_count = 0
-    for line in f_lines:
-        if pattern.match(line) is None:
-            header_count += 1
-        else:
+    end = -1
+    for _ in range(EXP_SAMPLE_LINES):
+        end = data.find("\n", end + 1)
+        if end == -1:
             break
+    sample = data if end == -1 else data[:end]
+    # Possible (delimiter, text) readings of the data, the likeliest first.
+    readings = [(None, data)]
+    if ";" in sample:
+        readings = [(";", data.replace(",", "."))]
+    elif "," in sample:
+        readings = [(",", data)]
+        if "." not in sample:
+            readings.insert(0, (None, data.replace(",", ".")))
 
-    with open(expfile, "w") as f:
-        for line in f_lines:
-            line = line.replace(".", ".")
-            f.write(line)
-    try:
-        x, y, *_ = np.genfromtxt(expfile, skip_header=header_count, unpack=True)
-    except ValueError:
-        raise
+    with irras_timing.stage("parse", file=str(expfile)):
+        for number, (delimiter, text) in enumerate(readings, start=1):
+            try:
+                x, y = np.loadtxt(text.splitlines(), delimiter=delimiter,
+                                  usecols=(0, 1), unpack=True, ndmin=2)
+                break
+            except ValueError:
+                if number == len(readings):
+                    raise
 
     y = np.add(y, bls)
     exp_spectrum = namedtuple("Spectrum", ["x", "y"])
     return exp_spectrum(x, y)
 
 
-def parse_params(paramfile):
-    """Parses the param file which must contain the x values (wave numbers)
-    of the experimental and calculated spectra in the first and second column
-    respectively which are to be used for fitting.
-    """
-    try:
-        with open(paramfile, "r") as f:
-            f_lines = f.readlines()
-    except FileNotFoundError:
-        sys.exit("Error! Parameter file not found! Exiting ...")
-    except TypeError:
-        sys.exit("Error! No parameter file was given! Exiting ...")
-
-    pattern = re.compile(r"^\d")
-    header_count = 0
-    for line in f_lines:
-        if pattern.match(line) is None:
-            header_count += 1
-        else:
-            break
-    exp, calc = np.genfromtxt(paramfile, skip_header=header_count, unpack=True)
-    return exp, calc
-
-
 def gaussian(x, amp, cen, sigma):
     """Returns the y value of a Gaussian at position x with amplitude amp.
     centered at cen and linewidth of sigma.
@@ -168,103 +333,799 @@ def gaussian(x, amp, cen, sigma):
     return y
 
 
-def broaden_spec(xvals, stick_x, stick_y, lw):
+def lorentzian(x, amp, cen, gamma):
+    """Returns the y value of a Lorentzian at position x with amplitude amp,
+    centered at cen and half width at half maximum of gamma.
+    """
+    y = amp * gamma ** 2 / ((x - cen) ** 2 + gamma ** 2)
+    return y
+
+
+def pseudo_voigt(x, amp, cen, sigma, eta=0.5):
+    """Returns the y value of a pseudo-Voigt profile at position x, i.e. the
+    sum of a Lorentzian (weighted by eta) and a Gaussian (weighted by 1 - eta)
+    with the same amplitude amp, center cen and full width at half maximum.
+    sigma is the linewidth of the Gaussian part.
+    """
+    return (eta * lorentzian(x, amp, cen, sigma * HWHM_PER_SIGMA)
+            + (1 - eta) * gaussian(x, amp, cen, sigma))
+
+
+def lineshape(x, shape, lw):
+    """Returns the profile of the given shape with unit amplitude centered at
+    0. lw is the linewidth of a Gaussian and all shapes share the full width
+    at half maximum of that Gaussian so that switching between them keeps the
+    width of the peaks.
+    """
+    if shape == "gaussian":
+        return gaussian(x, 1, 0, lw)
+    elif shape == "lorentzian":
+        return lorentzian(x, 1, 0, lw * HWHM_PER_SIGMA)
+    elif shape == "pseudo-voigt":
+        return pseudo_voigt(x, 1, 0, lw, PSEUDO_VOIGT_ETA)
+    raise ValueError(f"Error! Unknown lineshape '{shape}'")
+
+
+def _cutoff(shape, lw):
+    """Distance beyond which sticks do not contribute to the broadened
+    spectrum any more.
+    """
+    try:
+        return CUTOFFS[shape] * lw
+    except KeyError:
+        raise ValueError(f"Error! Unknown lineshape '{shape}'") from None
+
+
+def broaden_spec(xvals, stick_x, stick_y, lw, shape="gaussian",
+                 engine="auto"):
     """This creates a broadened spectrum from a stick spectrum passed
     in as stick_x and stick_y. The xvals passed are a separate array
     defining the x-range of the final spectrum.
     """
-    final_spec = []
-    for x in xvals:
-        total = 0
-        for xpos, yval in zip(stick_x, stick_y):
-            if abs(x - xpos) < 4 * lw:
-                total += gaussian(x, yval, xpos, lw)
-        final_spec.append(total)
+    return broaden_channels(xvals, stick_x, [stick_y], lw, shape, engine)[0]
+
+
+def broaden_channels(xvals, stick_x, stick_ys, lw, shape="gaussian",
+                     engine="auto"):
+    """Broadens several stick spectra sharing the same stick positions at
+    once, e.g. the total, x-, y- and z-polarized intensities. stick_ys is an
+    (n_channels, n_sticks) array and an (n_channels, len(xvals)) array is
+    returned. shape is one of LINESHAPES. engine is one of 'direct', 'fft' or
+    'auto' with the latter picking the cheaper one for the given problem size.
+    """
+    if not lw > 0:
+        raise ValueError("Error! Linewidth must be positive")
+    if engine == "auto":
+        engine = choose_engine(xvals, stick_x, lw, shape)
+    if engine not in ("direct", "fft"):
+        raise ValueError(f"Error! Unknown broadening engine '{engine}'")
+    # All channels are broadened in one go, so the time is per call and the
+    # number of channels is recorded along with it.
+    with irras_timing.stage("broaden", engine=engine, channels=len(stick_ys),
+                            sticks=len(stick_x), points=len(xvals)):
+        if engine == "direct":
+            return broaden_direct(xvals, stick_x, stick_ys, lw, shape)
+        return broaden_fft(xvals, stick_x, stick_ys, lw, shape)
+
+
+def is_uniform(xvals):
+    """Checks whether the points in xvals are equally spaced as is the case
+    for grids created with np.linspace.
+    """
+    steps = np.diff(xvals)
+    return steps.size > 0 and np.allclose(steps, steps[0], rtol=1e-6, atol=0)
+
+
+def choose_engine(xvals, stick_x, lw, shape="gaussian"):
+    """Returns the name of the broadening engine expected to be faster. The
+    direct sum scales with the number of grid points times the number of
+    sticks inside the cutoff window of each point while the FFT engine scales
+    with the size of its (oversampled) grid only. The latter needs a uniform
+    grid, though.
+    """
+    xvals = np.asarray(xvals, dtype=float)
+    stick_x = np.asarray(stick_x, dtype=float)
+    if stick_x.size == 0 or not is_uniform(xvals):
+        return "direct"
+    cutoff = _cutoff(shape, lw)
+    span = max(np.ptp(stick_x), np.ptp(xvals), lw)
+    window = stick_x.size * min(1, 2 * cutoff / span)
+    direct_cost = xvals.size * window
+    n_fine = xvals.size * _oversampling(abs(xvals[1] - xvals[0]), lw)
+    n_fine += 2 * cutoff / abs(xvals[1] - xvals[0])
+    fft_cost = FFT_COST_FACTOR * n_fine * np.log2(n_fine + 1)
+    return "fft" if fft_cost < direct_cost else "direct"
+
+
+def broaden_direct(xvals, stick_x, stick_ys, lw, shape="gaussian"):
+    """Direct summation engine. Only sticks inside the cutoff window of a grid
+    point (4 * lw for Gaussians) contribute to it. The sticks are sorted once
+    so that the sticks inside that window can be looked up with searchsorted
+    for a whole block of grid points at a time. The profiles of a block are
+    evaluated once and applied to all channels with a single matrix product.
+    """
+    xvals = np.asarray(xvals, dtype=float)
+    stick_x = np.asarray(stick_x, dtype=float)
+    stick_ys = np.atleast_2d(np.asarray(stick_ys, dtype=float))
+    cutoff = _cutoff(shape, lw)
+
+    order = np.argsort(stick_x, kind="stable")
+    stick_x = stick_x[order]
+    stick_ys = stick_ys[:, order]
+
+    final_spec = np.zeros((stick_ys.shape[0], xvals.size))
+    for start in range(0, xvals.size, BLOCK_SIZE):
+        block = xvals[start:start + BLOCK_SIZE]
+        lo = np.searchsorted(stick_x, block.min() - cutoff, side="right")
+        hi = np.searchsorted(stick_x, block.max() + cutoff, side="left")
+        if lo >= hi:
+            continue
+        # (block points x sticks in window) matrix of distances. Sticks at
+        # the edge of the window may still be too far from some of the points
+        # in the block and are masked out like in the original double loop.
+        dist = block[:, np.newaxis] - stick_x[np.newaxis, lo:hi]
+        kernel = lineshape(dist, shape, lw)
+        kernel[np.abs(dist) >= cutoff] = 0
+        final_spec[:, start:start + BLOCK_SIZE] = stick_ys[:, lo:hi] @ kernel.T
     return final_spec
 
 
+def _oversampling(dx, lw):
+    """Number of fine grid steps per step of the output grid needed to have
+    at least FFT_POINTS_PER_LW points per linewidth.
+    """
+    return max(1, int(np.ceil(FFT_POINTS_PER_LW * dx / lw)))
+
+
+@lru_cache(maxsize=KERNEL_CACHE_SIZE)
+def sampled_kernel(shape, lw, step):
+    """Returns the profile of the given shape sampled with the given step
+    within its cutoff window. The kernels are cached so that redrawing with
+    the same settings does not have to evaluate them again.
+    """
+    cutoff = _cutoff(shape, lw)
+    half_width = int(np.ceil(cutoff / step))
+    offsets = np.arange(-half_width, half_width + 1) * step
+    kernel = lineshape(offsets, shape, lw)
+    kernel[np.abs(offsets) >= cutoff] = 0
+    kernel.flags.writeable = False
+    return kernel
+
+
+@lru_cache(maxsize=KERNEL_CACHE_SIZE)
+def _kernel_fft(shape, lw, step, n_fft):
+    """Cached real FFT of sampled_kernel padded to n_fft points.
+    """
+    kernel_fft = np.fft.rfft(sampled_kernel(shape, lw, step), n_fft)
+    kernel_fft.flags.writeable = False
+    return kernel_fft
+
+
+def broaden_fft(xvals, stick_x, stick_ys, lw, shape="gaussian"):
+    """Convolution engine for uniform grids. The sticks are binned onto an
+    oversampled copy of the grid by splitting each intensity linearly between
+    its two neighbouring points, which is then convolved with the sampled
+    profile via FFT. The result deviates slightly from the direct sum (see
+    fft_error) but the cost no longer depends on the number of sticks or the
+    width of the profile.
+    """
+    xvals = np.asarray(xvals, dtype=float)
+    stick_x = np.asarray(stick_x, dtype=float)
+    stick_ys = np.atleast_2d(np.asarray(stick_ys, dtype=float))
+    if not is_uniform(xvals):
+        raise ValueError("Error! FFT broadening needs an equally spaced grid")
+    if xvals[-1] < xvals[0]:
+        return broaden_fft(xvals[::-1], stick_x, stick_ys, lw, shape)[:, ::-1]
+
+    oversample = _oversampling(xvals[1] - xvals[0], lw)
+    # Rounded so that grids with the same spacing hit the same cache entry.
+    step = float(np.round((xvals[-1] - xvals[0]) / (xvals.size - 1)
+                          / oversample, 12))
+    n_fine = (xvals.size - 1) * oversample + 1
+    kernel = sampled_kernel(shape, lw, step)
+    half_width = kernel.size // 2
+
+    # The fine grid is padded by the kernel width on both sides so that
+    # sticks just outside the plotted range still contribute to its edges.
+    pad = half_width + 1
+    length = n_fine + 2 * pad
+    pos = (stick_x - xvals[0]) / step + pad
+    inside = (pos >= 0) & (pos < length - 1)
+    pos = pos[inside]
+    left = np.floor(pos).astype(int)
+    frac = pos - left
+    binned = np.zeros((stick_ys.shape[0], length))
+    for channel, stick_y in zip(binned, stick_ys[:, inside]):
+        channel += np.bincount(left, stick_y * (1 - frac), length)
+        channel += np.bincount(left + 1, stick_y * frac, length)
+
+    n_fft = 1 << int(np.ceil(np.log2(length + kernel.size - 1)))
+    conv = np.fft.irfft(np.fft.rfft(binned, n_fft)
+                        * _kernel_fft(shape, lw, step, n_fft), n_fft)
+    # Index half_width of the full convolution belongs to the first point of
+    # the padded grid.
+    first = half_width + pad
+    return conv[:, first:first + n_fine:oversample]
+
+
+def fft_error(xvals, stick_x, stick_ys, lw, shape="gaussian"):
+    """Returns the largest deviation of the FFT engine from the exact direct
+    sum relative to the maximum of the exact spectrum for every channel.
+    """
+    exact = broaden_direct(xvals, stick_x, stick_ys, lw, shape)
+    approx = broaden_fft(xvals, stick_x, stick_ys, lw, shape)
+    scale = np.amax(np.abs(exact), axis=1)
+    scale[scale == 0] = 1
+    return np.amax(np.abs(approx - exact), axis=1) / scale
+
+
 def norm_spec(y):
     """This normalizes an array y given as argument.
     """
-    return np.divide(y, np.amax(y))
-
-
-# def spec_fit(exp, calc):
-#     """This determines the best fit of two spectra using scaling and
-#     x-shifting given two arrays which are taken from the parameter file.
-#     """
-#     slope, intercept, *_ = linregress(calc, exp)
-#     return slope, intercept
-
-
-# def fit(outfile, expfile, paramfile):
-#     """This is supposed to provide a solution to the least-squares fit of
-#     two spectra. Currently this uses user provided x-axis values of
-#     experimental and calculated spectra as parameters.
-#     """
-#     wn_calc, t2, x_pol, y_pol, z_pol = parse_outfile(outfile)
-#     wn_exp, y_exp = parse_exp(expfile)
-#     x_exp_fit, x_calc_fit = parse_params(paramfile)
-#
-#     y_exp = norm_spec(y_exp)
-#     f_exp = interp1d(wn_exp, y_exp, kind="cubic")
-#     f_x_calc = interp1d(wn_calc, x_pol, kind="cubic")
-#     f_y_calc = interp1d(wn_calc, y_pol, kind="cubic")
-#     f_z_calc = interp1d(wn_calc, z_pol, kind="cubic")
-#
-#     x_calc = np.array([f_x_calc(item) for item in x_calc_fit])
-#     y_calc = np.array([f_y_calc(item) for item in x_calc_fit])
-#     z_calc = np.array([f_z_calc(item) for item in x_calc_fit])
-#
-#     a = np.column_stack((x_calc, y_calc, z_calc))
-#     b = np.array([f_exp(item) for item in x_exp_fit])
-#     sol, *_ = nnls(a, b)
-#     return sol
+    with irras_timing.stage("normalize", points=len(y)):
+        return np.divide(y, np.amax(y))
+
+
+def resample(x_new, x, y):
+    """Linearly interpolates the spectrum given by x and y onto the points
+    x_new. x may be in descending order as is common for experimental
+    spectra. Points outside of the range of x are set to NaN.
+    """
+    x = np.asarray(x, dtype=float)
+    order = np.argsort(x, kind="stable")
+    return np.interp(x_new, x[order], np.asarray(y, dtype=float)[order],
+                     left=np.nan, right=np.nan)
+
+
+def decimate(x, y, x_lo, x_hi, ncols):
+    """Reduces the spectrum given by x (in ascending order) and y to the part
+    between x_lo and x_hi with at most four points per column when drawn
+    ncols columns (pixels) wide: the first, the minimum, the maximum and the
+    last point of every column. The drawn line covers the same pixels as the
+    full spectrum. One point on either side of the range is kept so that the
+    line reaches the edges.
+    """
+    start = max(np.searchsorted(x, x_lo, side="left") - 1, 0)
+    stop = min(np.searchsorted(x, x_hi, side="right") + 1, len(x))
+    x, y = x[start:stop], y[start:stop]
+    if len(x) <= 4 * ncols:
+        return x, y
+
+    # Column boundaries of the view, the points beyond it get columns of
+    # their own.
+    edges = np.searchsorted(x, np.linspace(x_lo, x_hi, ncols + 1))
+    starts = np.unique(np.concatenate([[0], edges]))
+    starts = starts[starts < len(x)]
+    lengths = np.diff(np.append(starts, len(x)))
+    # Positions of the first minimum and maximum of every column, kept in
+    # the order they appear in.
+    extrema = []
+    for reduce in (np.minimum, np.maximum):
+        hits = np.flatnonzero(y == np.repeat(reduce.reduceat(y, starts), lengths))
+        extrema.append(hits[np.searchsorted(hits, starts)])
+    indices = np.column_stack([starts, np.minimum(*extrema), np.maximum(*extrema),
+                               starts + lengths - 1]).ravel()
+    return x[indices], y[indices]
+
+
+def fit_spec(x_calc, components, x_exp, y_exp):
+    """Fits a linear combination with non-negative weights of the broadened
+    components (an (n_components, len(x_calc)) array such as the x-, y- and
+    z-polarized spectra) to the experimental spectrum. The experimental
+    spectrum is resampled onto x_calc and only the points covered by it are
+    used for fitting. Returns the weights and the fitted spectrum.
+    """
+    target = resample(x_calc, x_exp, y_exp)
+    inside = ~np.isnan(target)
+    if not inside.any():
+        raise ValueError("Error! Experimental and calculated spectra do not "
+                         "overlap")
+    from scipy.optimize import nnls
+
+    design = np.transpose(components)
+    weights, _ = nnls(design[inside], target[inside])
+    return weights, design @ weights
+
+
+def pick_peaks(x, y, prominence=PEAK_PROMINENCE):
+    """Returns the positions and heights of the peaks of a spectrum, sorted
+    by position. Only peaks standing out from their surroundings by at least
+    prominence times the range of y are kept, which drops noise and is not
+    affected by sloping baselines.
+    """
+    from scipy.signal import find_peaks
+
+    order = np.argsort(x, kind="stable")
+    x, y = np.asarray(x)[order], np.asarray(y)[order]
+    indices, _ = find_peaks(y, prominence=prominence * np.ptp(y))
+    return x[indices], y[indices]
+
+
+def _nearest_modes(peaks, positions, tolerance):
+    """Returns the indices of the peaks and of the nearest sorted positions
+    that are no further than tolerance from them. Every position is only
+    kept for the closest of the peaks it is nearest to.
+    """
+    right = np.searchsorted(positions, peaks).clip(0, len(positions) - 1)
+    left = (right - 1).clip(0, len(positions) - 1)
+    nearest = np.where(np.abs(positions[left] - peaks)
+                       <= np.abs(positions[right] - peaks), left, right)
+    distances = np.abs(positions[nearest] - peaks)
+    matched = np.flatnonzero(distances <= tolerance)
+    if not len(matched):
+        return matched, matched
+    modes = nearest[matched]
+    order = np.lexsort((distances[matched], modes))
+    first = np.concatenate(([True], np.diff(modes[order]) != 0))
+    matched = np.sort(matched[order][first])
+    return matched, nearest[matched]
+
+
+def _refine_assignment(peaks, positions, scalefactor, tolerance):
+    """Alternates between assigning the sorted positions scaled by
+    scalefactor to the peaks and fitting the scale factor to the pairs by
+    least squares until the pairs stay the same. Returns the indices of the
+    pairs and the scale factor, or None if nothing could be assigned.
+    """
+    pairs = None
+    for _ in range(PEAK_MAX_ITERATIONS):
+        matched, nearest = _nearest_modes(peaks, positions * scalefactor,
+                                          tolerance)
+        if not len(matched):
+            return None
+        calc = positions[nearest]
+        scalefactor = np.dot(peaks[matched], calc) / np.dot(calc, calc)
+        if pairs is not None and np.array_equal(pairs[0], matched) \
+                and np.array_equal(pairs[1], nearest):
+            break
+        pairs = (matched, nearest)
+    return matched, nearest, scalefactor
+
+
+def assign_peaks(peaks, wn, intensities, scalefactors=(1,),
+                 tolerance=PEAK_TOLERANCE, min_intensity=PEAK_MIN_INTENSITY):
+    """Assigns the calculated modes at the unscaled wave numbers wn to the
+    experimental peak positions. Every peak gets the nearest scaled mode with
+    an intensity of at least min_intensity times the strongest one, if it is
+    no further than tolerance. The scale factor is then fitted to the pairs
+    and the modes are assigned again until the pairs stay the same. Dense
+    spectra have several such assignments, so this is started from every
+    value of scalefactors and the one with the most pairs, and the smallest
+    deviation among those, wins. Sorting and binary searches make every start
+    O(n log n). Returns an Assignment with the indices of the assigned peaks
+    and modes, their positions, the scale factor and the root mean square
+    deviation of the pairs.
+    """
+    peaks = np.asarray(peaks, dtype=float)
+    wn, intensities = np.asarray(wn), np.asarray(intensities)
+    modes = np.flatnonzero(intensities >= min_intensity * np.amax(intensities))
+    modes = modes[np.argsort(wn[modes], kind="stable")]
+    positions = wn[modes]
+    if not len(peaks) or not len(modes):
+        raise ValueError("Error! No peaks to assign")
+
+    best = None
+    for start in np.atleast_1d(scalefactors):
+        refined = _refine_assignment(peaks, positions, start, tolerance)
+        if refined is None:
+            continue
+        matched, nearest, scalefactor = refined
+        rmsd = np.sqrt(np.mean(np.square(
+            peaks[matched] - scalefactor * positions[nearest])))
+        if best is None or (len(matched), -rmsd) > (len(best[0]), -best[3]):
+            best = (matched, nearest, scalefactor, rmsd)
+    if best is None:
+        raise ValueError("Error! No calculated mode is within the tolerance "
+                         "of an experimental peak")
+
+    matched, nearest, scalefactor, rmsd = best
+    assignment = namedtuple("Assignment", ["peaks", "modes", "exp", "calc",
+                                           "scalefactor", "rmsd"])
+    return assignment(matched, modes[nearest], peaks[matched],
+                      positions[nearest], scalefactor, rmsd)
+
+
+def _load_conformer(outfile, scalefactor=1, cache=None):
+    # Module level so that it can be sent to the worker processes.
+    try:
+        if cache is None:
+            return parse_outfile(outfile, scalefactor)
+        return cache.load(parse_outfile, outfile, scalefactor=scalefactor)
+    except ValueError:
+        raise ValueError(f"Error! Invalid ORCA output file '{outfile}'") \
+            from None
+
+
+def parse_ensemble(outfiles, temperature=298.15, scalefactor=1, workers=None,
+                   cache=None, mp_context=None):
+    """Parses the ORCA outputs of a conformer ensemble in parallel (unless
+    workers is 1) and combines them with Boltzmann weights at temperature
+    (in K) from their final single point energies. cache is an optional
+    irras_cache.SpectrumCache and mp_context the multiprocessing context of the
+    worker processes. Returns the combined spectrum, the weights and the
+    spectra of the conformers.
+    """
+    load = partial(_load_conformer, scalefactor=scalefactor, cache=cache)
+    if workers == 1 or len(outfiles) < 2:
+        spectra = [load(outfile) for outfile in outfiles]
+    else:
+        # Single outputs parse in about a millisecond, so they are handed to
+        # the workers in chunks.
+        chunksize = max(1, len(outfiles) // (4 * (workers or os.cpu_count())))
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=mp_context) as pool:
+            spectra = list(pool.map(load, outfiles, chunksize=chunksize))
+
+    for outfile, spectrum in zip(outfiles, spectra):
+        if np.isnan(spectrum.energy):
+            raise ValueError(f"Error! No final single point energy in "
+                             f"'{outfile}'")
+    weights = boltzmann_weights([spectrum.energy for spectrum in spectra],
+                                temperature)
+    ensemble = namedtuple("Ensemble", ["spectrum", "weights", "spectra"])
+    return ensemble(combine_spectra(spectra, weights), weights, spectra)
+
+
+def boltzmann_weights(energies, temperature):
+    """Returns the Boltzmann weights (summing up to 1) of states with the
+    given energies in Hartree at temperature in K.
+    """
+    if temperature <= 0:
+        raise ValueError("Error! The temperature must be positive")
+    energies = np.asarray(energies, dtype=float)
+    # Relative to the lowest energy, the exponentials cannot underflow all
+    # at once.
+    weights = np.exp(-(energies - np.amin(energies))
+                     / (BOLTZMANN_HARTREE * temperature))
+    return weights / np.sum(weights)
+
+
+def combine_spectra(spectra, weights):
+    """Concatenates the sticks of several spectra from parse_outfile into a
+    single spectrum with the intensities scaled by weights, so that the
+    ensemble is broadened in one go. The dipoles are scaled by the square
+    root of the weights as the intensities are their squares. The energy is
+    the weighted mean.
+    """
+    per_stick = np.repeat(weights, [len(spectrum) for spectrum in spectra])
+    combined = StickSpectrum(
+        np.concatenate([spectrum.data for spectrum in spectra]),
+        np.dot(weights, [spectrum.energy for spectrum in spectra]))
+    combined.intensities[...] *= per_stick
+    combined.dipoles[...] *= np.sqrt(per_stick)[:, np.newaxis]
+    return combined
+
+
+def surface_normals(thetas, phis):
+    """Returns the surface normal in the frame of the molecule for every
+    combination of the tilt angles thetas and the azimuthal angles phis (in
+    degrees) as (len(thetas) * len(phis), 3) array, with phi varying fastest.
+    The molecule is rotated by phi about its z axis and then tilted by theta
+    about the y axis, i.e. R = R_y(theta) R_z(phi), and the normals are the
+    last rows of this batch of rotation matrices.
+    """
+    theta, phi = np.meshgrid(np.radians(thetas), np.radians(phis),
+                             indexing="ij")
+    theta, phi = theta.ravel(), phi.ravel()
+    return np.column_stack([-np.sin(theta) * np.cos(phi),
+                            np.sin(theta) * np.sin(phi),
+                            np.cos(theta)])
+
+
+def orientation_intensities(dipoles, thetas, phis):
+    """Returns the IRRAS intensities of all modes for all orientations given
+    by the angles thetas and phis as (n_orientations, n_modes) array. By the
+    surface selection rule only the component of the transition dipole along
+    the surface normal is IR active so that the intensity is its square.
+    """
+    return (surface_normals(thetas, phis) @ np.transpose(dipoles)) ** 2
+
+
+def angle_spectra(x_calc, wn, dipoles, thetas, phis, lw, shape="gaussian",
+                  engine="auto"):
+    """Returns the broadened IRRAS spectra for all orientations as
+    (len(thetas) * len(phis), len(x_calc)) array. All orientations are
+    broadened in a single pass as channels of broaden_channels.
+    """
+    return broaden_channels(x_calc, wn,
+                            orientation_intensities(dipoles, thetas, phis),
+                            lw, shape, engine)
+
+
+def fit_angle(x_calc, spectra, x_exp, y_exp):
+    """Finds the spectrum in the stack spectra (e.g. from angle_spectra)
+    which agrees best with the experimental spectrum after scaling it with a
+    non-negative factor. Returns the index of that spectrum, its scaling
+    factor and the mean squared deviations of all spectra.
+    """
+    target = resample(x_calc, x_exp, y_exp)
+    inside = ~np.isnan(target)
+    if not inside.any():
+        raise ValueError("Error! Experimental and calculated spectra do not "
+                         "overlap")
+    spectra = np.asarray(spectra)[:, inside]
+    target = target[inside]
+    norms = np.einsum("ij,ij->i", spectra, spectra)
+    norms[norms == 0] = 1
+    scales = np.clip(spectra @ target / norms, 0, None)
+    deviations = np.mean((spectra * scales[:, np.newaxis] - target) ** 2,
+                         axis=1)
+    best = np.argmin(deviations)
+    return best, scales[best], deviations
+
+
+def spec_deviation(params, x_calc, wn, t_sq, target, shape="gaussian"):
+    """Returns the mean squared deviation between the normalized experimental
+    spectrum target (already resampled onto x_calc) and the normalized
+    calculated spectrum for params = (scalefactor, linewidth, baselineshift).
+    The baseline shift is added to target like in the GUI. If it is None, the
+    optimal shift is used, which is the mean deviation of the two spectra.
+    Also returns that shift. Linewidths below the spacing of x_calc are
+    rejected, as such spectra are only a few aliased spikes.
+    """
+    scalefactor, lw, bls = params
+    if scalefactor <= 0 or lw < x_calc[1] - x_calc[0]:
+        return np.inf, bls
+    inside = ~np.isnan(target)
+    calc = broaden_spec(x_calc, np.multiply(wn, scalefactor), t_sq, lw, shape)
+    peak = np.amax(calc)
+    if peak <= 0:
+        return np.inf, bls
+    diff = calc[inside] / peak - target[inside]
+    if bls is None:
+        bls = np.mean(diff)
+    return np.mean((diff - bls) ** 2), bls
+
+
+# Problem shared by all evaluations of a worker process. Set once per process
+# by _init_optimizer so that the arrays are not sent along with every task.
+_problem = None
+
+
+def _init_optimizer(problem):
+    global _problem
+    _problem = problem
+
+
+def _grid_row(lw, scalefactors):
+    """Evaluates one row of the coarse grid, i.e. all scale factors for one
+    linewidth, which lets all evaluations of a row share the cached kernel.
+    Returns the deviations, the optimal baseline shifts and the time spent.
+    """
+    start = time.perf_counter()
+    row = [spec_deviation((scalefactor, lw, None), *_problem)
+           for scalefactor in scalefactors]
+    deviations, shifts = zip(*row)
+    return deviations, shifts, time.perf_counter() - start
+
+
+def optimize_params(x_calc, wn, t_sq, x_exp, y_exp, sf_range=(0.9, 1.05, 16),
+                    lw_range=(5, 30, 11), shape="gaussian", workers=None,
+                    mp_context=None):
+    """Searches the scale factor, linewidth and baseline shift for which the
+    normalized total calculated spectrum agrees best with the normalized
+    experimental spectrum. A coarse (linewidth x scale factor) grid given by
+    the (min, max, number of points) ranges is evaluated in parallel, using
+    the optimal baseline shift for each point. The best grid point is then
+    refined locally in all three parameters, keeping the scale factor and
+    the linewidth within the ranges of the grid. The experimental spectrum is
+    resampled onto x_calc only once. mp_context is the multiprocessing
+    context of the worker processes. Returns an Optimization namedtuple with
+    the best parameters, the deviation surface of the grid and timings.
+    """
+    start = time.perf_counter()
+    target = resample(x_calc, x_exp, y_exp)
+    if np.isnan(target).all():
+        raise ValueError("Error! Experimental and calculated spectra do not "
+                         "overlap")
+    problem = (x_calc, wn, t_sq, target, shape)
+    scalefactors = np.linspace(*sf_range[:2], int(sf_range[2]))
+    linewidths = np.linspace(*lw_range[:2], int(lw_range[2]))
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context,
+                             initializer=_init_optimizer,
+                             initargs=(problem,)) as pool:
+        rows = list(pool.map(_grid_row, linewidths,
+                             [scalefactors] * linewidths.size))
+    surface = np.array([deviations for deviations, _, _ in rows])
+    shifts = np.array([row_shifts for _, row_shifts, _ in rows])
+    eval_time = sum(row_time for _, _, row_time in rows)
+    evaluations = surface.size
+
+    from scipy.optimize import minimize
+
+    i, j = np.unravel_index(np.argmin(surface), surface.shape)
+    local_start = time.perf_counter()
+    bounds = [(scalefactors[0], scalefactors[-1]),
+              (max(linewidths[0], x_calc[1] - x_calc[0]), linewidths[-1]),
+              (None, None)]
+    local = minimize(lambda params: spec_deviation(params, *problem)[0],
+                     [scalefactors[j], linewidths[i], shifts[i, j]],
+                     method="Powell", bounds=bounds,
+                     options={"xtol": 1e-4, "ftol": 1e-10})
+    eval_time += time.perf_counter() - local_start
+    evaluations += local.nfev
+    if local.fun < surface[i, j]:
+        best = (*local.x, local.fun)
+    else:
+        best = (scalefactors[j], linewidths[i], shifts[i, j], surface[i, j])
+
+    optimization = namedtuple("Optimization", [
+        "scalefactor", "linewidth", "baselineshift", "deviation",
+        "scalefactors", "linewidths", "surface", "evaluations",
+        "time_per_eval", "wall_time"])
+    return optimization(*best, scalefactors, linewidths, surface, evaluations,
+                        eval_time / evaluations, time.perf_counter() - start)
 
 
 def main():
-    wn, t2, x_pol, y_pol, z_pol = parse_outfile(args.outfile, args.scalefactor)
-    if args.expfile:
-        x_exp, y = parse_exp(args.expfile, args.baselineshift)
-        y = norm_spec(y)
-        plt.plot(x_exp, y, label="Experimental Spectrum")
+    from matplotlib import pyplot as plt
 
+    cache = None if args.no_cache else irras_cache.SpectrumCache(args.cache_dir)
+    if cache is None:
+        def load(parser, path, **kwargs):
+            return parser(path, **kwargs)
+    else:
+        load = cache.load
+
+    if args.ensemble:
+        ensemble = parse_ensemble(args.ensemble, args.temperature,
+                                  args.scalefactor, args.workers, cache)
+        for outfile, conformer, weight in zip(args.ensemble, ensemble.spectra,
+                                              ensemble.weights):
+            print(f"{outfile}: E = {conformer.energy:.6f} Eh, "
+                  f"weight = {weight:.4f}")
+        spectrum = ensemble.spectrum
+    elif args.follow:
+        spectrum = follow_outfile(args.outfile, args.scalefactor,
+                                  args.interval)
+    else:
+        spectrum = load(parse_outfile, args.outfile,
+                        scalefactor=args.scalefactor)
+    wn, t2 = spectrum.wn, spectrum.t_sq
     x_min, x_max = args.xmin, args.xmax
     x_calc = np.linspace(x_min, x_max, args.npoints)
 
-    y1 = broaden_spec(x_calc, wn, x_pol, args.linewidth)
-    y2 = broaden_spec(x_calc, wn, y_pol, args.linewidth)
-    y3 = broaden_spec(x_calc, wn, z_pol, args.linewidth)
-    y4 = broaden_spec(x_calc, wn, t2, args.linewidth)
+    # The spectra always go to the first figure, additional plots such as the
+    # angle map get figures of their own.
+    plt.figure(1)
+    if args.expfile:
+        x_exp, y = load(parse_exp, args.expfile, bls=args.baselineshift)
+        y = norm_spec(y)
+    if args.optimize:
+        if not args.expfile:
+            sys.exit("Error! Optimizing requires an experimental spectrum! "
+                     "Exiting ...")
+        wn = np.divide(wn, args.scalefactor)
+        result = optimize_params(x_calc, wn, t2, x_exp, y, args.sf_range,
+                                 args.lw_range, args.lineshape, args.workers)
+        print(f"Scale factor: {result.scalefactor:.4f}\n"
+              f"Linewidth: {result.linewidth:.2f}\n"
+              f"Baseline shift: {result.baselineshift:.4f}\n"
+              f"Mean squared deviation: {result.deviation:.3e}\n"
+              f"{result.evaluations} evaluations, "
+              f"{result.time_per_eval * 1000:.2f} ms per evaluation, "
+              f"{result.wall_time:.2f} s total")
+        plot_surface(result)
+        plt.figure(1)
+        wn = np.multiply(wn, result.scalefactor)
+        args.scalefactor = result.scalefactor
+        args.linewidth = result.linewidth
+        y = np.add(y, result.baselineshift)
+    if args.expfile:
+        plt.plot(x_exp, y, label="Experimental Spectrum")
+    if args.peaks:
+        if not args.expfile:
+            sys.exit("Error! Assigning peaks requires an experimental "
+                     "spectrum! Exiting ...")
+        wn = np.divide(wn, args.scalefactor)
+        peak_x, peak_y = pick_peaks(x_exp, y, args.prominence)
+        # Started from the current scale factor and those of --sf-range.
+        starts = np.append(args.scalefactor, np.linspace(
+            args.sf_range[0], args.sf_range[1], int(args.sf_range[2])))
+        assignment = assign_peaks(peak_x, wn, t2, starts, args.tolerance)
+        print(f"{'exp.':>9} {'calc.':>9} {'scaled':>9} {'dev.':>7} "
+              f"{'T**2':>9}")
+        for exp, calc, mode in zip(assignment.exp, assignment.calc,
+                                   assignment.modes):
+            scaled = calc * assignment.scalefactor
+            print(f"{exp:>9.1f} {calc:>9.1f} {scaled:>9.1f} "
+                  f"{exp - scaled:>7.1f} {t2[mode]:>9.5f}")
+        print(f"Assigned {len(assignment.exp)} of {len(peak_x)} peaks\n"
+              f"Scale factor: {assignment.scalefactor:.4f}\n"
+              f"RMS deviation: {assignment.rmsd:.1f} cm**-1")
+        wn = np.multiply(wn, assignment.scalefactor)
+        plt.plot(assignment.exp, peak_y[assignment.peaks], "kv",
+                 label="Assigned peaks")
+
+    broadened = BroadenedSpectrum(x_calc, broaden_channels(
+        x_calc, wn, spectrum.intensities, args.linewidth, args.lineshape,
+        args.engine))
 
-    # if args.plot:
-    norm_factor = np.amax(y4)
+    # All channels are normalized at once, by the maximum of the total.
+    with irras_timing.stage("normalize", points=len(x_calc)):
+        y1, y2, y3, y4 = broadened.normalized
     if args.plotx:
-        plt.plot(x_calc, np.divide(y1, norm_factor), "b", label="x-pol. Calc. Spectrum")
+        plt.plot(x_calc, y1, "b", label="x-pol. Calc. Spectrum")
     if args.ploty:
-        plt.plot(x_calc, np.divide(y2, norm_factor), "r", label="y-pol. Calc. Spectrum")
+        plt.plot(x_calc, y2, "r", label="y-pol. Calc. Spectrum")
     if args.plotz:
-        plt.plot(x_calc, np.divide(y3, norm_factor), "y", label="z-pol. Calc. Spectrum")
+        plt.plot(x_calc, y3, "y", label="z-pol. Calc. Spectrum")
     if args.plottotal:
-        plt.plot(x_calc, norm_spec(y4), "k", label="Total Calc. Spectrum")
-    # elif args.fit:
-    #     params = fit(args.outfile, args.expfile, args.paramfile)
-    #     norm = np.linalg.norm(params)
-    #     n_y1, n_y2, n_y3 = np.divide(params, norm)
-    #     y5 = np.multiply(y1, n_y1) + np.multiply(y2, n_y2) + np.multiply(y3,
-    #                                                                      n_y3)
-    #     y5 = norm_spec(y5)
-    #     plt.plot(x_calc, y5, "g", label=f"Fitted spectrum with\n{n_y1:.2f}"
-    #                                     f" {n_y2:.2f} {n_y3:.2f}")
-    # else:
-    #     sys.exit(("Error! Neither plotting nor fitting was requested! Exiting"
-    #               " ..."))
+        plt.plot(x_calc, y4, "k", label="Total Calc. Spectrum")
+    if args.fit:
+        if not args.expfile:
+            sys.exit("Error! Fitting requires an experimental spectrum! "
+                     "Exiting ...")
+        (w_x, w_y, w_z), y5 = fit_spec(x_calc, broadened.normalized[:3],
+                                       x_exp, y)
+        plt.plot(x_calc, y5, "g", label=f"Fitted spectrum with\n{w_x:.2f}"
+                                        f" {w_y:.2f} {w_z:.2f}")
 
+    if args.anglemap:
+        thetas = np.arange(0, 90 + args.theta_step / 2, args.theta_step)
+        phis = np.arange(0, 360, args.phi_step)
+        stack = angle_spectra(x_calc, wn, spectrum.dipoles, thetas, phis,
+                              args.linewidth, args.lineshape, args.engine)
+        if args.expfile:
+            best, scale, _ = fit_angle(x_calc, stack, x_exp, y)
+            theta, phi = thetas[best // phis.size], phis[best % phis.size]
+            plt.plot(x_calc, stack[best] * scale, "m",
+                     label=f"Best orientation\n(θ = {theta:.0f}°, "
+                           f"φ = {phi:.0f}°)")
+        plot_anglemap(x_calc, thetas, stack.reshape(thetas.size, phis.size, -1)
+                      .mean(axis=1) / np.amax(stack))
+
+    plt.figure(1)
     plt.xlim(x_max, x_min)
     plt.legend()
+    if irras_timing.enabled:
+        # Rendering would otherwise only happen within plt.show(), which
+        # also waits for the window to be closed.
+        with irras_timing.stage("draw"):
+            plt.gcf().canvas.draw()
     plt.show()
 
 
+def plot_surface(result):
+    """Plots the deviation surface of an Optimization from optimize_params in
+    a new figure.
+    """
+    from matplotlib import pyplot as plt
+
+    plt.figure()
+    plt.pcolormesh(result.scalefactors, result.linewidths, result.surface,
+                   shading="nearest")
+    plt.colorbar(label="Mean squared deviation")
+    plt.plot(result.scalefactor, result.linewidth, "rx")
+    plt.xlabel("Scale factor")
+    plt.ylabel("Linewidth")
+
+
+def plot_anglemap(x_calc, thetas, spectra):
+    """Plots the spectra for the tilt angles thetas as a map in a new figure.
+    """
+    from matplotlib import pyplot as plt
+
+    plt.figure()
+    plt.pcolormesh(x_calc, thetas, spectra, shading="nearest")
+    plt.colorbar(label="Intensity / a.u.")
+    plt.xlim(x_calc[-1], x_calc[0])
+    plt.xlabel("Wavenumber")
+    plt.ylabel("Tilt angle θ / °")
+
+
 if __name__ == "__main__":
     args = parse_args().parse_args()
-    main()
+    if args.timings:
+        irras_timing.enable(args.timings)
+    profiler = cProfile.Profile() if args.profile else None
+    try:
+        if profiler:
+            profiler.runcall(main)
+        else:
+            main()
+    finally:
+        if profiler:
+            profiler.dump_stats(args.profile)
+        irras_timing.disable()
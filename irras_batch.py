@@ -0,0 +1,173 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+import irras_angle
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(parents=[irras_angle.broadening_parser()],
+                                     description="""
+        Broadens the IR spectra of many ORCA outputs in parallel and writes
+        the total, x-, y- and z-polarized spectra to text files. Nothing is
+        plotted.""")
+    parser.add_argument("inputs", nargs="+",
+                        help="ORCA output files, glob patterns or directories")
+    parser.add_argument("-p", "--pattern", metavar="", default="*.out",
+                        help="Glob pattern for the files taken from "
+                             "directories (Default = *.out)")
+    parser.add_argument("-od", "--outdir", metavar="", default=".",
+                        help="Directory the broadened spectra are written to")
+    parser.add_argument("-j", "--workers", metavar="", type=int, default=None,
+                        help="Number of worker processes (Default = number "
+                             "of CPUs)")
+    parser.add_argument("-c", "--chunksize", metavar="", type=int, default=1,
+                        help="Number of files handed to a worker at once")
+    parser.add_argument("-r", "--report", metavar="",
+                        help="Write the per-file timings to this file as "
+                             "tab-separated values")
+    parser.add_argument("--normalize", action="store_true",
+                        help="Divide all components by the maximum of the "
+                             "total spectrum")
+    return parser
+
+
+def collect_files(inputs, pattern="*.out"):
+    """Expands directories and glob patterns into a list of files without
+    duplicates. Inputs that match nothing are kept as they are so that they
+    show up as failed jobs instead of silently vanishing.
+    """
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            files.extend(sorted(glob.glob(os.path.join(item, pattern))))
+        else:
+            files.extend(sorted(glob.glob(item)) or [item])
+    return list(dict.fromkeys(files))
+
+
+def output_stems(paths):
+    """Returns the names (without extension) the outputs for paths are
+    written under. These are the file names, except for different files
+    sharing one, e.g. the outputs of per-job ORCA directories like a/job.out
+    and b/job.out. Those are named after their path relative to the common
+    directory of all of them, with the separators replaced by underscores
+    (a_job and b_job).
+    """
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    groups = {}
+    for index, stem in enumerate(stems):
+        groups.setdefault(stem, []).append(index)
+    for indices in groups.values():
+        absolute = [os.path.abspath(paths[index]) for index in indices]
+        if len(set(absolute)) < 2:
+            continue
+        common = os.path.commonpath(absolute)
+        for index, path in zip(indices, absolute):
+            relative = os.path.splitext(os.path.relpath(path, common))[0]
+            stems[index] = relative.replace(os.sep, "_")
+    return stems
+
+
+def run_job(function, *args, **kwargs):
+    """Calls function in a worker process. Returns its result and None, or
+    None and the message of the error it raised, so that a single bad file
+    only fails its own job. parse_outfile exits for missing files, which
+    must not end the worker either.
+    """
+    try:
+        return function(*args, **kwargs), None
+    except (Exception, SystemExit) as err:
+        return None, str(err) or type(err).__name__
+
+
+def process_file(path, stem, options):
+    """Parses and broadens a single ORCA output and writes the spectra to
+    options.outdir as stem.dat. Runs in the worker processes. Errors are
+    returned as part of the result so that a single bad file does not abort
+    the whole batch.
+    """
+    result = {"file": path, "output": None, "error": None,
+              "parse": 0.0, "broaden": 0.0, "write": 0.0}
+    result["output"], result["error"] = run_job(write_spectra, path, stem,
+                                                options, result)
+    return result
+
+
+def write_spectra(path, stem, options, timings):
+    """Does the work of process_file, putting the time of every step into
+    timings. Returns the name of the written file.
+    """
+    start = time.perf_counter()
+    spectrum = irras_angle.parse_outfile(path, options.scalefactor)
+    timings["parse"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    x_calc = np.linspace(options.xmin, options.xmax, options.npoints)
+    channels = irras_angle.broaden_channels(
+        x_calc, spectrum.wn,
+        [spectrum.t_sq, spectrum.x, spectrum.y, spectrum.z],
+        options.linewidth, options.lineshape, options.engine)
+    if options.normalize:
+        channels = np.divide(channels, np.amax(channels[0]))
+    timings["broaden"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    output = os.path.join(options.outdir, f"{stem}.dat")
+    np.savetxt(output, np.column_stack([x_calc, *channels]), fmt="%.8e",
+               header="wavenumber total x y z")
+    timings["write"] = time.perf_counter() - start
+    return output
+
+
+def write_report(results, reportfile):
+    with open(reportfile, "w") as f:
+        f.write("file\tstatus\tparse\tbroaden\twrite\terror\n")
+        for result in results:
+            status = "failed" if result["error"] else "ok"
+            f.write(f"{result['file']}\t{status}\t{result['parse']:.6f}\t"
+                    f"{result['broaden']:.6f}\t{result['write']:.6f}\t"
+                    f"{result['error'] or ''}\n")
+
+
+def main():
+    files = collect_files(args.inputs, args.pattern)
+    stems = output_stems(files)
+    if len(set(stems)) < len(stems):
+        sys.exit("Error! Some of the ORCA outputs would be written to the "
+                 "same file! Exiting ...")
+    os.makedirs(args.outdir, exist_ok=True)
+
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for result in pool.map(partial(process_file, options=args), files,
+                               stems, chunksize=args.chunksize):
+            results.append(result)
+            name = os.path.basename(result["file"])
+            if result["error"]:
+                print(f"{name}: FAILED ({result['error']})", file=sys.stderr)
+            else:
+                print(f"{name}: parse {result['parse']:.4f} s, broaden "
+                      f"{result['broaden']:.4f} s, write "
+                      f"{result['write']:.4f} s")
+    wall_time = time.perf_counter() - start
+
+    failed = sum(1 for result in results if result["error"])
+    print(f"Processed {len(results)} files ({failed} failed) in "
+          f"{wall_time:.2f} s")
+    if args.report:
+        write_report(results, args.report)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    args = parse_args().parse_args()
+    main()
@@ -0,0 +1,389 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import irras_angle
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "examples")
+DEFAULT_HISTORY = "irras_bench_history.jsonl"
+# Problem sizes of the synthetic cases of the suite.
+SUITE_MODES = [100, 1000, 10000, 100000]
+SUITE_POINTS = [1000, 10000, 100000, 1000000]
+SUITE_EXP_LINES = [1000, 10000, 100000, 1000000]
+# Used instead with --quick, e.g. to check that the suite runs at all.
+QUICK_MODES = [100, 1000]
+QUICK_POINTS = [1000, 10000]
+QUICK_EXP_LINES = [1000, 10000]
+# Budgets in seconds for importing the modules in a fresh interpreter. Worker
+# processes import irras_angle, so it has to stay cheap.
+IMPORT_BUDGETS = {"irras_angle": 0.3, "irras_batch": 0.3, "irras_library": 0.3,
+                  "irras_cache": 0.3, "irras_store": 0.3, "irras_follow": 0.3,
+                  "irras_export": 0.3, "irras_gui": 1.5}
+# Modules which only GUI_MODULES may import at import time, all others have
+# to import them where they are needed.
+LAZY_MODULES = ("matplotlib", "scipy.optimize", "tkinter")
+GUI_MODULES = ("irras_gui",)
+# Imports a module given on the command line and prints the time it took, the
+# peak memory if asked for and the lazy modules it imported as JSON.
+IMPORT_SCRIPT = """
+import json, sys, time, tracemalloc
+if sys.argv[2] == "memory":
+    tracemalloc.start()
+start = time.perf_counter()
+__import__(sys.argv[1])
+seconds = time.perf_counter() - start
+print(json.dumps({"time": seconds, "peak": tracemalloc.get_traced_memory()[1],
+                  "lazy": [name for name in sys.argv[3:] if name in sys.modules]}))
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="""
+        Times the direct and FFT broadening engines on synthetic stick spectra
+        and compares them to the original pure Python implementation. With
+        --suite, parsing, broadening, normalization and drawing are timed on
+        the bundled examples and on synthetic files of increasing size and the
+        results are appended to a history file. --compare prints the changes
+        between two runs of the history. --imports checks the time it takes
+        to import the modules.""")
+    parser.add_argument("-m", "--nmodes", metavar="", type=int, nargs="+",
+                        default=[100, 1000, 5000],
+                        help="Numbers of modes of the synthetic spectra")
+    parser.add_argument("-n", "--npoints", metavar="", type=int, default=4096,
+                        help="Number of grid points")
+    parser.add_argument("-lw", "--linewidth", metavar="", type=float,
+                        default=15, help="Linewidth used for broadening")
+    parser.add_argument("-r", "--repeat", metavar="", type=int, default=3,
+                        help="Number of repetitions, the best one is reported")
+    parser.add_argument("--skip-loop", action="store_true",
+                        help="Do not time the original double loop which "
+                             "gets very slow for large spectra")
+    parser.add_argument("-s", "--suite", action="store_true",
+                        help="Run the benchmark suite and append the results "
+                             "to the history file")
+    parser.add_argument("-q", "--quick", action="store_true",
+                        help="Only use the smallest sizes of the suite")
+    parser.add_argument("-H", "--history", metavar="", default=DEFAULT_HISTORY,
+                        help="History file of the suite (Default = "
+                             f"{DEFAULT_HISTORY})")
+    parser.add_argument("-l", "--label", metavar="",
+                        help="Name of the suite run in the history (Default = "
+                             "current git revision)")
+    parser.add_argument("-i", "--imports", action="store_true",
+                        help="Check the import times of all modules against "
+                             "their budgets")
+    parser.add_argument("-c", "--compare", metavar="", nargs=2,
+                        help="Compare two runs of the history given by label "
+                             "or index, e.g. -2 -1 for the last two runs")
+    return parser
+
+
+def broaden_spec_loop(xvals, stick_x, stick_y, lw):
+    """The original double loop version of broaden_spec. Kept as reference
+    for timing and to check the results of the vectorized one.
+    """
+    final_spec = []
+    for x in xvals:
+        total = 0
+        for xpos, yval in zip(stick_x, stick_y):
+            if abs(x - xpos) < 4 * lw:
+                total += irras_angle.gaussian(x, yval, xpos, lw)
+        final_spec.append(total)
+    return final_spec
+
+
+def synthetic_sticks(nmodes, xmin=500, xmax=4000, seed=0):
+    """Returns random stick positions and intensities within the given range.
+    """
+    rng = np.random.default_rng(seed)
+    return rng.uniform(xmin, xmax, nmodes), rng.exponential(1, nmodes)
+
+
+def best_time(func, repeat, *args):
+    """Returns the best wall time of repeat calls of func and its result.
+    """
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def peak_memory(func, *args):
+    """Returns the peak memory in bytes allocated during func(*args). numpy
+    reports its array allocations to tracemalloc, so they are included.
+    """
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def import_module(module, memory=False):
+    """Imports module in a fresh interpreter and returns the time it took,
+    the peak memory allocated meanwhile (only if memory is set, tracing slows
+    the import down) and the LAZY_MODULES it imported.
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT, module,
+         "memory" if memory else "time", *LAZY_MODULES],
+        capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    result = json.loads(output)
+    return result["time"], result["peak"], result["lazy"]
+
+
+def import_times(repeat):
+    """Yields every module of IMPORT_BUDGETS with its best import time out
+    of repeat runs, the peak memory and the lazy modules it imported.
+    """
+    for module in IMPORT_BUDGETS:
+        seconds = min(import_module(module)[0] for _ in range(repeat))
+        _, peak, lazy = import_module(module, memory=True)
+        yield module, seconds, peak, [] if module in GUI_MODULES else lazy
+
+
+def check_imports():
+    print(f"{'module':<14} {'time / s':>10} {'budget / s':>11}  lazy modules "
+          "imported")
+    failed = 0
+    for module, seconds, _, lazy in import_times(args.repeat):
+        over = seconds > IMPORT_BUDGETS[module] or lazy
+        failed += bool(over)
+        print(f"{module:<14} {seconds:>10.4f} {IMPORT_BUDGETS[module]:>11.2f}  "
+              f"{', '.join(lazy) or '-'}{'  OVER BUDGET' if over else ''}")
+    if failed:
+        sys.exit(f"Error! {failed} modules exceed their import budget! "
+                 "Exiting ...")
+
+
+def write_outfile(path, nmodes, seed=0):
+    """Writes a minimal ORCA output with an IR spectrum block of nmodes
+    random transitions which parse_outfile accepts.
+    """
+    rng = np.random.default_rng(seed)
+    wn = np.sort(rng.uniform(10, 4000, nmodes))
+    dipoles = rng.normal(0, 0.05, (nmodes, 3))
+    t_sq = np.sum(dipoles ** 2, axis=1)
+    with open(path, "w") as f:
+        f.write("-----------\nIR SPECTRUM\n-----------\n\n Mode   freq       "
+                "eps      Int      T**2         TX        TY        TZ\n"
+                + "-" * 76 + "\n")
+        for mode, (freq, t2, (tx, ty, tz)) in enumerate(zip(wn, t_sq, dipoles),
+                                                        start=6):
+            f.write(f"{mode:5d}: {freq:9.2f} {t2:10.6f} {t2 * 500:7.2f} "
+                    f"{t2:9.6f}  ({tx:9.6f} {ty:9.6f} {tz:9.6f})\n")
+        f.write("\n* The epsilon (eps) is given for a Dirac delta lineshape.\n")
+
+
+def write_expfile(path, nlines, seed=0):
+    """Writes a two column experimental spectrum with nlines rows.
+    """
+    rng = np.random.default_rng(seed)
+    x = np.linspace(4000, 400, nlines)
+    np.savetxt(path, np.column_stack([x, rng.normal(0, 1e-3, nlines)]),
+               fmt="%.5f", delimiter="\t")
+
+
+def suite_cases(tmpdir, quick=False):
+    """Yields the name, parameters, function and arguments of all cases of
+    the suite. Synthetic input files are written to tmpdir.
+    """
+    modes = QUICK_MODES if quick else SUITE_MODES
+    points = QUICK_POINTS if quick else SUITE_POINTS
+    exp_lines = QUICK_EXP_LINES if quick else SUITE_EXP_LINES
+    calcfile = os.path.join(EXAMPLES_DIR, "calc.out")
+
+    yield "parse_outfile", {"file": "calc.out"}, irras_angle.parse_outfile, \
+        (calcfile,)
+    for name in ("exp.txt", "Moewe_IRRAS.txt", "Moewe_Bulk_IR.txt"):
+        yield "parse_exp", {"file": name}, irras_angle.parse_exp, \
+            (os.path.join(EXAMPLES_DIR, name),)
+    for nmodes in modes:
+        path = os.path.join(tmpdir, f"synthetic_{nmodes}.out")
+        write_outfile(path, nmodes)
+        yield "parse_outfile", {"modes": nmodes}, irras_angle.parse_outfile, \
+            (path,)
+    for nlines in exp_lines:
+        path = os.path.join(tmpdir, f"synthetic_{nlines}.txt")
+        write_expfile(path, nlines)
+        yield "parse_exp", {"lines": nlines}, irras_angle.parse_exp, (path,)
+
+    spectrum = irras_angle.parse_outfile(calcfile)
+    yield "broaden_spec", {"file": "calc.out", "points": 875}, \
+        irras_angle.broaden_spec, \
+        (np.linspace(500, 4000, 875), spectrum.wn, spectrum.t_sq, 15)
+    for nmodes in modes:
+        wn, intensity = synthetic_sticks(nmodes)
+        for npoints in points:
+            yield "broaden_spec", {"modes": nmodes, "points": npoints}, \
+                irras_angle.broaden_spec, \
+                (np.linspace(500, 4000, npoints), wn, intensity, 15)
+    for npoints in points:
+        y = np.random.default_rng(0).normal(0, 1, npoints)
+        yield "norm_spec", {"points": npoints}, irras_angle.norm_spec, (y,)
+
+    draw = gui_draw_case(calcfile, os.path.join(EXAMPLES_DIR, "exp.txt"))
+    if draw is not None:
+        yield "draw_graph", {"file": "calc.out"}, draw, ()
+
+
+def gui_draw_case(calcfile, expfile):
+    """Returns a function which redraws the GUI with a new linewidth each
+    time it is called, including broadening in the worker and rendering of
+    the canvas, or None if there is no display.
+    """
+    import tkinter as tk
+    import irras_gui
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        print("No display available, skipping draw_graph", file=sys.stderr)
+        return None
+    root.withdraw()
+    app = irras_gui.MainApplication(root)
+    app.configure_gui()
+    app.create_widgets()
+    app.calc_loaded(calcfile, irras_angle.parse_outfile(calcfile), None)
+    app.exp_loaded((expfile,), [irras_angle.parse_exp(expfile)], None)
+    linewidths = iter(np.arange(10, 1e6, 0.01))
+
+    def draw():
+        # A new linewidth every time so that no memoized spectra are used.
+        app.linewidth_default.set(f"{next(linewidths):.2f}")
+        app.draw_graph()
+        while app.worker.busy():
+            time.sleep(1e-4)
+            app.process_results()
+        app.canvas.draw()
+
+    return draw
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+                              capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))
+                              ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def format_params(params):
+    return ", ".join(f"{key}={value}" for key, value in params.items())
+
+
+def run_suite():
+    results = []
+    print(f"{'case':<14} {'parameters':<30} {'time / s':>10} {'peak / MiB':>11}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, params, func, func_args in suite_cases(tmpdir, args.quick):
+            seconds, _ = best_time(func, args.repeat, *func_args)
+            peak = peak_memory(func, *func_args)
+            results.append({"case": name, "params": params, "time": seconds,
+                            "peak_memory": peak})
+            print(f"{name:<14} {format_params(params):<30} {seconds:>10.5f} "
+                  f"{peak / 2 ** 20:>11.2f}")
+    for module, seconds, peak, _ in import_times(args.repeat):
+        results.append({"case": "import", "params": {"module": module},
+                        "time": seconds, "peak_memory": peak})
+        print(f"{'import':<14} {format_params({'module': module}):<30} "
+              f"{seconds:>10.5f} {peak / 2 ** 20:>11.2f}")
+
+    record = {"label": args.label or git_revision(),
+              "date": datetime.datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(), "numpy": np.__version__,
+              "machine": platform.platform(), "repeat": args.repeat,
+              "results": results}
+    with open(args.history, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    print(f"Results of '{record['label']}' appended to {args.history}")
+
+
+def find_run(history, name):
+    """Returns the last run with the given label or the run at the given
+    index of the history.
+    """
+    for record in reversed(history):
+        if record["label"] == name:
+            return record
+    try:
+        return history[int(name)]
+    except (ValueError, IndexError):
+        sys.exit(f"Error! No run '{name}' in the benchmark history! Exiting ...")
+
+
+def compare_runs():
+    try:
+        with open(args.history, "r") as f:
+            history = [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        sys.exit("Error! Benchmark history file not found! Exiting ...")
+    old, new = (find_run(history, name) for name in args.compare)
+    old_results = {(result["case"], format_params(result["params"])): result
+                   for result in old["results"]}
+
+    print(f"Comparing '{old['label']}' ({old['date']}) with '{new['label']}' "
+          f"({new['date']})")
+    print(f"{'case':<14} {'parameters':<30} {'old / s':>10} {'new / s':>10} "
+          f"{'ratio':>7} {'mem. ratio':>10}")
+    for result in new["results"]:
+        key = (result["case"], format_params(result["params"]))
+        if key not in old_results:
+            continue
+        previous = old_results[key]
+        print(f"{key[0]:<14} {key[1]:<30} {previous['time']:>10.5f} "
+              f"{result['time']:>10.5f} {result['time'] / previous['time']:>7.2f} "
+              f"{result['peak_memory'] / max(previous['peak_memory'], 1):>10.2f}")
+
+
+def main():
+    if args.compare:
+        compare_runs()
+        return
+    if args.suite:
+        run_suite()
+        return
+    if args.imports:
+        check_imports()
+        return
+    x_calc = np.linspace(500, 4000, args.npoints)
+    print(f"{'modes':>8} {'loop / s':>10} {'direct / s':>12} {'fft / s':>10} "
+          f"{'speedup':>9} {'max. dev.':>10} {'fft error':>10}")
+    for nmodes in args.nmodes:
+        wn, intensity = synthetic_sticks(nmodes)
+        t_vec, y_vec = best_time(irras_angle.broaden_direct, args.repeat,
+                                 x_calc, wn, [intensity], args.linewidth)
+        t_fft, _ = best_time(irras_angle.broaden_fft, args.repeat,
+                             x_calc, wn, [intensity], args.linewidth)
+        fft_err = irras_angle.fft_error(x_calc, wn, [intensity],
+                                        args.linewidth)[0]
+        if args.skip_loop:
+            t_loop, speedup, dev = "-", "-", "-"
+        else:
+            t_loop, y_loop = best_time(broaden_spec_loop, 1, x_calc, wn,
+                                       intensity, args.linewidth)
+            dev = f"{np.amax(np.abs(y_vec[0] - y_loop)):.2e}"
+            speedup = f"{t_loop / min(t_vec, t_fft):.1f}"
+            t_loop = f"{t_loop:.4f}"
+        print(f"{nmodes:>8} {t_loop:>10} {t_vec:>12.4f} {t_fft:>10.4f} "
+              f"{speedup:>9} {dev:>10} {fft_err:>10.2e}")
+
+
+if __name__ == "__main__":
+    args = parse_args().parse_args()
+    main()
@@ -0,0 +1,162 @@
+import hashlib
+import os
+import tempfile
+import zipfile
+from collections import namedtuple
+
+import numpy as np
+
+import irras_timing
+from irras_spectrum import StickSpectrum
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "irras")
+# Total size of all cache entries after which the least recently used ones
+# are deleted.
+DEFAULT_MAX_BYTES = 256 * 2 ** 20
+# Size of the chunks at the beginning and the end of a file which are hashed
+# to detect changed contents. The IR spectrum block of ORCA outputs is at the
+# very end so the tail chunk catches a rerun job in the same file.
+HASH_CHUNK = 2 ** 16
+# Part of the key of all entries. Must be increased whenever the fields of the
+# parsed spectra change so that outdated entries are not used any more.
+FORMAT_VERSION = 4
+
+
+def content_hash(path, size):
+    """Hashes the first and the last HASH_CHUNK bytes of a file. Hashing the
+    complete file would defeat the purpose of the cache for large ORCA
+    outputs.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        digest.update(f.read(HASH_CHUNK))
+        if size > HASH_CHUNK:
+            f.seek(max(HASH_CHUNK, size - HASH_CHUNK))
+            digest.update(f.read(HASH_CHUNK))
+    return digest.digest()
+
+
+class SpectrumCache:
+    """Stores the StickSpectrum objects and Spectrum namedtuples returned by
+    the parsers of irras_angle as .npz files in a cache directory so that
+    loading the same file again skips the text parsing. Entries are keyed by
+    the path, size, mtime and content hash of the parsed file as well as the
+    parser and its arguments. The least recently used entries are deleted
+    once the cache grows beyond max_bytes.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, parser, path, **kwargs):
+        """Returns the name of the cache entry for parser(path, **kwargs).
+        """
+        stat = os.stat(path)
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr((FORMAT_VERSION, os.path.abspath(path),
+                            stat.st_size, stat.st_mtime_ns, parser.__module__,
+                            parser.__name__, sorted(kwargs.items())))
+                      .encode())
+        digest.update(content_hash(path, stat.st_size))
+        return digest.hexdigest()
+
+    def load(self, parser, path, **kwargs):
+        """Returns parser(path, **kwargs) from the cache if possible and
+        parses and stores it otherwise.
+        """
+        try:
+            entry = os.path.join(self.directory,
+                                 self.key(parser, path, **kwargs) + ".npz")
+        except (OSError, TypeError):
+            # Leave the error handling for missing files to the parser.
+            return parser(path, **kwargs)
+
+        try:
+            with np.load(entry) as data:
+                if "_sticks" in data:
+                    spectrum = StickSpectrum(data["_sticks"], data["energy"])
+                else:
+                    fields = [str(field) for field in data["_fields"]]
+                    spectrum = namedtuple("Spectrum", fields)(
+                        *(data[field] for field in fields))
+            # The mtime of the entries serves as last access time for eviction.
+            os.utime(entry)
+        except FileNotFoundError:
+            self.misses += 1
+            irras_timing.count("cache_misses")
+        except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+            # Truncated or otherwise corrupt entries are removed and replaced.
+            self.misses += 1
+            irras_timing.count("cache_misses")
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+        else:
+            self.hits += 1
+            irras_timing.count("cache_hits")
+            return spectrum
+
+        spectrum = parser(path, **kwargs)
+        self.store(entry, spectrum)
+        return spectrum
+
+    def store(self, entry, spectrum):
+        """Writes spectrum to the cache file entry and evicts old entries if
+        necessary. Caching is a bonus only, so errors such as a read-only
+        cache directory are silently ignored.
+        """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp",
+                                             delete=False) as f:
+                tmpname = f.name
+                if isinstance(spectrum, StickSpectrum):
+                    np.savez(f, _sticks=spectrum.data, energy=spectrum.energy)
+                else:
+                    np.savez(f, _fields=np.array(spectrum._fields),
+                             **{field: np.asarray(value) for field, value
+                                in spectrum._asdict().items()})
+            # Renaming is atomic so that concurrent readers never see
+            # partially written entries.
+            os.replace(tmpname, entry)
+            self.evict()
+        except OSError:
+            try:
+                os.remove(tmpname)
+            except (OSError, UnboundLocalError):
+                pass
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache is no
+        larger than max_bytes.
+        """
+        entries = []
+        with os.scandir(self.directory) as it:
+            for item in it:
+                if item.name.endswith(".npz"):
+                    stat = item.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, item.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        """Deletes all entries and resets the hit and miss counters.
+        """
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith(".npz"):
+                    os.remove(os.path.join(self.directory, name))
+        self.hits = 0
+        self.misses = 0
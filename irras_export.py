@@ -0,0 +1,219 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+
+import numpy as np
+
+import irras_angle
+import irras_batch
+from irras_spectrum import CALC_COMPONENTS, BroadenedSpectrum
+
+FORMATS = ("png", "svg", "pdf")
+
+# Figure of the worker process and its artists, see init_worker. Every plot
+# only sets new data on them.
+_figure = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(parents=[irras_angle.broadening_parser()],
+                                     description="""
+        Renders overlays of calculated and experimental spectra to image
+        files in parallel, without opening any window. Every worker process
+        draws all its figures on a single reused figure.""")
+    parser.add_argument("inputs", nargs="*",
+                        help="ORCA output files, glob patterns or directories")
+    parser.add_argument("-e", "--expfile", metavar="",
+                        help="Experimental spectrum overlaid on all figures")
+    parser.add_argument("-P", "--pairs", metavar="",
+                        help="File with an ORCA output and optionally an "
+                             "experimental spectrum per line, separated by "
+                             "whitespace")
+    parser.add_argument("-p", "--pattern", metavar="", default="*.out",
+                        help="Glob pattern for the files taken from "
+                             "directories (Default = *.out)")
+    parser.add_argument("-od", "--outdir", metavar="", default=".",
+                        help="Directory the figures are written to")
+    parser.add_argument("-f", "--format", metavar="", default="png",
+                        choices=FORMATS,
+                        help="Format of the figures: png, svg or pdf "
+                             "(Default = png)")
+    parser.add_argument("--dpi", metavar="", type=int, default=100,
+                        help="Resolution of png figures (Default = 100)")
+    parser.add_argument("-j", "--workers", metavar="", type=int, default=None,
+                        help="Number of worker processes (Default = number "
+                             "of CPUs)")
+    parser.add_argument("-c", "--chunksize", metavar="", type=int, default=1,
+                        help="Number of figures handed to a worker at once")
+    parser.add_argument("-bs", "--baselineshift", metavar="", type=float,
+                        default=0, help="Shift of the normalized experimental "
+                                        "spectra")
+    parser.add_argument("-x", "--plotx", action="store_true",
+                        help="Plot the x-polarized spectrum")
+    parser.add_argument("-y", "--ploty", action="store_true",
+                        help="Plot the y-polarized spectrum")
+    parser.add_argument("-z", "--plotz", action="store_true",
+                        help="Plot the z-polarized spectrum")
+    parser.add_argument("-t", "--plottotal", action="store_false",
+                        help="Do not plot the total spectrum")
+    return parser
+
+
+def read_pairs(pairsfile):
+    """Returns the (ORCA output, experimental spectrum or None) pairs listed
+    in pairsfile. Empty lines and lines starting with # are skipped.
+    """
+    try:
+        with open(pairsfile, "r") as f:
+            lines = [line.split() for line in f
+                     if line.strip() and not line.lstrip().startswith("#")]
+    except FileNotFoundError:
+        sys.exit("Error! Pairs file not found! Exiting ...")
+    if any(len(fields) > 2 for fields in lines):
+        raise ValueError("Error! Invalid pairs file")
+    return [(fields[0], fields[1] if len(fields) == 2 else None)
+            for fields in lines]
+
+
+def init_worker(options):
+    """Creates the figure and all artists of the worker process once. The
+    Agg canvas is used directly, so neither pyplot nor a GUI backend is ever
+    loaded.
+    """
+    global _figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(10, 7), dpi=options.dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.set_xlabel("Wavenumber", weight="bold")
+    ax.set_ylabel("Intensity / a.u.", weight="bold")
+    exp_line, = ax.plot([], [], linewidth=2)
+    lines, fills = {}, {}
+    for name, _, color, linewidth, label in CALC_COMPONENTS:
+        lines[name], = ax.plot([], [], color, linewidth=linewidth, label=label)
+        if name != "tot":
+            fills[name] = ax.fill_between([0, 1], [0, 0], color=color,
+                                          alpha=0.3)
+    ax.set_xlim(options.xmax, options.xmin)
+    # Normalized spectra always span about the same range, so the layout is
+    # only computed once.
+    fig.tight_layout()
+    _figure = fig, ax, exp_line, lines, fills
+
+
+@lru_cache(maxsize=8)
+def load_exp(expfile, baselineshift, x_lo, x_hi, ncols):
+    """Returns the experimental spectrum normalized, shifted and decimated
+    to the pixel columns of the figure. Kept for the figures sharing it.
+    """
+    x, y = irras_angle.parse_exp(expfile)
+    order = np.argsort(x, kind="stable")
+    y = irras_angle.norm_spec(y)[order] + baselineshift
+    return irras_angle.decimate(x[order], y, x_lo, x_hi, ncols)
+
+
+def output_stems(pairs):
+    """Returns the names (without extension) the figures of the pairs are
+    saved under: the name of the ORCA output followed by that of the
+    experimental spectrum, both made unique as in irras_batch.output_stems.
+    """
+    calc_stems = irras_batch.output_stems([calcfile for calcfile, _ in pairs])
+    expfiles = list(dict.fromkeys(expfile for _, expfile in pairs if expfile))
+    exp_stems = dict(zip(expfiles, irras_batch.output_stems(expfiles)))
+    return [f"{stem}_{exp_stems[expfile]}" if expfile else stem
+            for stem, (_, expfile) in zip(calc_stems, pairs)]
+
+
+def render(pair, stem, options):
+    """Draws the overlay of a (ORCA output, experimental spectrum or None)
+    pair on the figure of the worker and saves it to options.outdir as stem.
+    Errors are returned as part of the result like in irras_batch.
+    """
+    calcfile, expfile = pair
+    result = {"file": calcfile, "output": None, "error": None, "time": 0.0}
+    start = time.perf_counter()
+    result["output"], result["error"] = irras_batch.run_job(
+        save_figure, calcfile, expfile, stem, options)
+    result["time"] = time.perf_counter() - start
+    return result
+
+
+def save_figure(calcfile, expfile, stem, options):
+    """Does the work of render. Returns the name of the saved figure.
+    """
+    fig, ax, exp_line, lines, fills = _figure
+    spectrum = irras_angle.parse_outfile(calcfile, options.scalefactor)
+    x_calc = np.linspace(options.xmin, options.xmax, options.npoints)
+    broadened = BroadenedSpectrum(x_calc, irras_angle.broaden_channels(
+        x_calc, spectrum.wn, spectrum.intensities, options.linewidth,
+        options.lineshape, options.engine))
+
+    visible = {"tot": options.plottotal, "x": options.plotx,
+               "y": options.ploty, "z": options.plotz}
+    for name, channel, *_ in CALC_COMPONENTS:
+        y = broadened.normalized[channel]
+        lines[name].set_data(x_calc, y)
+        lines[name].set_visible(visible[name])
+        if name in fills:
+            # Same polygon as fill_between(x, y) creates.
+            fills[name].set_verts([np.concatenate(
+                ([[x_calc[0], 0]], np.column_stack((x_calc, y)),
+                 [[x_calc[-1], 0]]))])
+            fills[name].set_visible(visible[name])
+    if expfile:
+        ncols = int(fig.get_figwidth() * fig.dpi)
+        exp_line.set_data(*load_exp(expfile, options.baselineshift,
+                                    options.xmin, options.xmax, ncols))
+        exp_line.set_label(os.path.basename(expfile))
+    exp_line.set_visible(bool(expfile))
+
+    ax.relim(visible_only=True)
+    ax.autoscale_view(scalex=False)
+    ax.legend(handles=[artist for artist in (exp_line, *lines.values())
+                       if artist.get_visible()])
+
+    output = os.path.join(options.outdir, f"{stem}.{options.format}")
+    fig.savefig(output)
+    return output
+
+
+def main():
+    pairs = [(path, args.expfile) for path
+             in irras_batch.collect_files(args.inputs, args.pattern)]
+    if args.pairs:
+        pairs.extend(read_pairs(args.pairs))
+    pairs = list(dict.fromkeys(pairs))
+    if not pairs:
+        sys.exit("Error! No ORCA output files were given! Exiting ...")
+    stems = output_stems(pairs)
+    if len(set(stems)) < len(stems):
+        sys.exit("Error! Some of the figures would be written to the same "
+                 "file! Exiting ...")
+    os.makedirs(args.outdir, exist_ok=True)
+
+    start = time.perf_counter()
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                             initargs=(args,)) as pool:
+        for result in pool.map(partial(render, options=args), pairs,
+                               stems, chunksize=args.chunksize):
+            name = os.path.basename(result["file"])
+            if result["error"]:
+                failed += 1
+                print(f"{name}: FAILED ({result['error']})", file=sys.stderr)
+            else:
+                print(f"{name}: {result['output']} in {result['time']:.4f} s")
+    print(f"Exported {len(pairs) - failed} figures ({failed} failed) in "
+          f"{time.perf_counter() - start:.2f} s")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    args = parse_args().parse_args()
+    main()
@@ -0,0 +1,106 @@
+import os
+
+import numpy as np
+
+import irras_spectrum
+
+# Maximum number of bytes read per poll. Keeps the cost of a single poll
+# constant while a lot is appended at once, the rest is read by the next
+# polls.
+MAX_READ = 2 ** 20
+# Lines ORCA writes when a job ends, normally or not.
+END_MARKERS = (b"ORCA TERMINATED NORMALLY", b"error termination")
+
+
+class OutfileFollower:
+    """Follows an ORCA output that is still being written. Every poll() only
+    reads the bytes appended since the last one, starting from the
+    remembered offset, and scans the complete lines among them for the IR
+    spectrum block and the energy. Incomplete lines and a block whose end has
+    not been written yet are kept until the next poll. The file being
+    truncated or replaced, e.g. by restarting the job, starts over.
+    """
+
+    def __init__(self, path, scalefactor=1, max_read=MAX_READ):
+        self.path = path
+        self.scalefactor = scalefactor
+        self.max_read = max_read
+        self.reset()
+
+    def reset(self, file_id=None):
+        self.file_id = file_id
+        self.offset = 0
+        self.size = 0
+        self.pending = b""
+        self.block = None
+        self.energy = np.nan
+        self.spectrum = None
+        self.finished = False
+
+    def poll(self):
+        """Reads what was appended since the last poll. Returns the Spectrum
+        of parse_outfile if a new IR spectrum block was completed and None
+        otherwise.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            # The job may not have been started yet.
+            return None
+        file_id = (stat.st_dev, stat.st_ino)
+        if file_id != self.file_id or stat.st_size < self.offset:
+            self.reset(file_id)
+        self.size = stat.st_size
+        if stat.st_size == self.offset:
+            return None
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(min(stat.st_size - self.offset, self.max_read))
+        self.offset += len(data)
+
+        # Only complete lines are scanned so that no marker is split.
+        data = self.pending + data
+        cut = data.rfind(b"\n") + 1
+        data, self.pending = data[:cut], data[cut:]
+        return self.scan(data)
+
+    @property
+    def behind(self):
+        """Whether there is more to read than a single poll reads.
+        """
+        return self.offset < self.size
+
+    def scan(self, data):
+        spectrum = None
+        while data:
+            if self.block is None:
+                start = data.find(irras_spectrum.IR_BLOCK_START)
+                self.update(data if start == -1 else data[:start])
+                if start == -1:
+                    break
+                self.block, data = b"", data[start:]
+            # The end marker may span the end of the block read so far and
+            # the beginning of the new data.
+            block = self.block + data
+            end = block.find(irras_spectrum.IR_BLOCK_END,
+                             max(len(self.block) - 1, 1))
+            if end == -1:
+                self.block = block
+                break
+            self.block, data = None, block[end + 1:]
+            try:
+                spectrum = irras_spectrum.spectrum_from_block(
+                    block[:end], self.energy, self.scalefactor)
+            except ValueError:
+                # Anything but an actual IR spectrum block.
+                continue
+        if spectrum is not None:
+            self.spectrum = spectrum
+        return spectrum
+
+    def update(self, data):
+        energy = irras_spectrum.last_energy(data)
+        if not np.isnan(energy):
+            self.energy = energy
+        if any(marker in data for marker in END_MARKERS):
+            self.finished = True
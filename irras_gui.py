@@ -1,14 +1,113 @@
+from collections import OrderedDict
+import itertools
+import multiprocessing
 from os.path import basename
+import queue
+import threading
 import tkinter as tk
 import tkinter.filedialog
 import tkinter.messagebox
 
 from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg,
                                                NavigationToolbar2Tk)
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import numpy as np
 
 import irras_angle
+import irras_cache
+import irras_follow
+import irras_timing
+from irras_spectrum import CALC_COMPONENTS, BroadenedSpectrum
+from irras_store import SpectrumStore
+
+# Number of broadened calculated spectra kept in memory so that going back to
+# previous parameters does not recompute them.
+BROADENED_MEMO_SIZE = 16
+# Interval in ms in which the Tk main loop picks up results of the worker.
+POLL_INTERVAL = 10
+# Interval in ms in which a followed ORCA output is checked for new output.
+FOLLOW_INTERVAL = 2000
+# Minimum interval in ms between two redraws while a slider is moved. Slider
+# events in between are coalesced so that only the latest values are drawn.
+LIVE_INTERVAL = 30
+# Parameter sliders: entry, range, resolution and format of the values
+# written into the entry.
+SLIDERS = [("xmin", 0, 4000, 10, "{:.0f}"),
+           ("xmax", 500, 5000, 10, "{:.0f}"),
+           ("baseline", -1, 1, 0.01, "{:.2f}"),
+           ("linewidth", 1, 60, 0.5, "{:.1f}"),
+           ("scalefactor", 0.8, 1.1, 0.001, "{:.3f}")]
+# Changing these only changes the data of the drawn artists, so the
+# background of the axis can be reused while their sliders are dragged.
+BLIT_SLIDERS = ("baseline", "linewidth", "scalefactor")
+# Context of the process pools started by the worker thread. Forking a
+# process with several threads, such as the Tk main loop and the worker, can
+# deadlock the child, so the processes are spawned instead.
+PROCESS_CONTEXT = multiprocessing.get_context("spawn")
+
+
+class Worker(threading.Thread):
+    """Runs parsing and broadening jobs in a background thread so that the
+    Tk main loop stays responsive. Results are put into a queue which the GUI
+    polls via after(). Submitting a job supersedes all earlier jobs of the
+    same kind: pending ones are skipped and the results of a running one are
+    dropped.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.latest = {}
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def submit(self, kind, callback, func, *args):
+        """Queues func(*args). callback(result, error) is called from the
+        main loop once it finished unless it has been superseded by then.
+        """
+        job_id = next(self.counter)
+        with self.lock:
+            self.latest[kind] = job_id
+        self.jobs.put((kind, job_id, callback, func, args))
+        return job_id
+
+    def cancel(self, kind):
+        with self.lock:
+            self.latest.pop(kind, None)
+
+    def is_current(self, kind, job_id):
+        with self.lock:
+            return self.latest.get(kind) == job_id
+
+    def busy(self):
+        with self.lock:
+            return bool(self.latest)
+
+    def finish(self, kind, job_id):
+        with self.lock:
+            if self.latest.get(kind) == job_id:
+                del self.latest[kind]
+
+    def run(self):
+        while True:
+            kind, job_id, callback, func, args = self.jobs.get()
+            if not self.is_current(kind, job_id):
+                continue
+            try:
+                result, error = func(*args), None
+            # parse_outfile exits for missing files, which must not end the
+            # worker.
+            except (Exception, SystemExit) as err:
+                result, error = None, err
+            self.results.put((kind, job_id, callback, result, error))
+
+
+def broaden(x_calc, wn, intensities, linewidth, lineshape):
+    # Broadening job run by the worker. Returns the BroadenedSpectrum with
+    # the x, y, z and total spectra.
+    return BroadenedSpectrum(x_calc, irras_angle.broaden_channels(
+        x_calc, wn, intensities, linewidth, lineshape))
 
 
 class MainApplication(tk.Frame):
@@ -16,6 +115,39 @@ class MainApplication(tk.Frame):
     def __init__(self, master):
         self.master = master
         tk.Frame.__init__(self, self.master)
+        # Parsed spectra are cached on disk so that reopening the same files
+        # skips parsing them.
+        self.cache = irras_cache.SpectrumCache()
+        # Artists are kept and updated with new data instead of clearing the
+        # axis on every redraw. Broadened spectra are memoized by the
+        # parameters they were computed with.
+        self.exp_lines = {}
+        self.exp_view = None
+        self.calc_lines = {}
+        self.calc_fills = {}
+        self.overlay_lines = []
+        # Entries of a spectrum store plotted as they are, keyed by row. Only
+        # the plotted rows are read from the store.
+        self.store = None
+        self.store_lines = {}
+        self.calc_key = None
+        self.broadened = OrderedDict()
+        # Conformer ensemble the calculated spectrum was combined from, if
+        # any, and the temperature of its weights.
+        self.ensemble = None
+        self.temperature = None
+        # ORCA output of a running job which is checked for its IR spectrum
+        # with after(), see poll_follower.
+        self.follower = None
+        self.follow_job = None
+        self.worker = Worker()
+        self.worker.start()
+        # State of the slider being dragged, see begin_live. synced holds the
+        # values the sliders were last set to from the entries.
+        self.synced = {}
+        self.live_job = None
+        self.dragging = False
+        self.background = None
 
     def configure_gui(self):
         # Setup frames to put stuff in.
@@ -36,6 +168,24 @@ class MainApplication(tk.Frame):
         self.create_statusbar(self.status_frame)
         self.draw_canvas(self.graph_frame)
         self.create_user_input(self.button_frame)
+        self.sync_sliders()
+        self.after(POLL_INTERVAL, self.poll_worker)
+
+    def poll_worker(self):
+        self.process_results()
+        self.after(POLL_INTERVAL, self.poll_worker)
+
+    def process_results(self):
+        # Hands the results of finished jobs to their callbacks. Results of
+        # superseded jobs are thrown away.
+        while True:
+            try:
+                kind, job_id, callback, result, error = self.worker.results.get_nowait()
+            except queue.Empty:
+                break
+            if self.worker.is_current(kind, job_id):
+                self.worker.finish(kind, job_id)
+                callback(result, error)
 
     def create_menubar(self, root):
         self.menu = tk.Menu(root)
@@ -47,43 +197,225 @@ class MainApplication(tk.Frame):
                                                     command=self.get_exp)
         self.calcbutton = self.file_menu.add_command(label="Open calc file",
                                                      command=self.get_calc)
+        self.ensemblebutton = self.file_menu.add_command(
+            label="Open conformer ensemble", command=self.get_ensemble)
+        self.followbutton = self.file_menu.add_command(
+            label="Follow running ORCA job", command=self.get_follow)
+        self.storebutton = self.file_menu.add_command(
+            label="Open spectrum store", command=self.get_store)
+
+        self.debug_menu = tk.Menu(self.menu)
+        self.menu.add_cascade(label="Debug", menu=self.debug_menu)
+        self.timings = tk.BooleanVar(master=root, value=False)
+        self.debug_menu.add_checkbutton(label="Print stage timings",
+                                        variable=self.timings,
+                                        command=self.toggle_timings)
+
+    def toggle_timings(self):
+        # Stage timings are written to stderr as JSON lines, the totals are
+        # written when switching them off again.
+        if self.timings.get():
+            irras_timing.enable()
+        else:
+            irras_timing.disable()
 
     def get_exp(self):
         # askopenfilenames() allows selection of multiple files and returns
         # a tuple.
-        self.expfiles = tk.filedialog.askopenfilenames()
+        expfiles = tk.filedialog.askopenfilenames()
         # Checking whether a file was actually selected. Would otherwise throw
         # error if "cancel" was pressed
-        if self.expfiles:
-            self.x_exp = []
-            self.y_exp = []
-            # Handling of errors from invalid files happens here. Much more
-            # convenient than having that later on.
+        if expfiles:
+            self.status_var_exp.set("Loading experimental spectra ...")
+            self.worker.submit("exp", lambda result, error: self.exp_loaded(
+                expfiles, result, error), self.load_exp, expfiles)
+
+    def load_exp(self, expfiles):
+        # Runs in the worker thread. Handling of errors from invalid files
+        # happens in exp_loaded, the name of the offending file is passed on
+        # with the exception.
+        spectra = []
+        for file in expfiles:
             try:
-                for file in self.expfiles:
-                    self.x_exp.append(irras_angle.parse_exp(file)[0])
-                    self.y_exp.append(irras_angle.parse_exp(file)[1])
-                self.draw_graph()
-            except ValueError:
-                # Can only be reached once the "file" local variable has already
-                # been declared in the above for-loop so it's fine.
-                tk.messagebox.showerror("Error", f"Invalid experimental file: {basename(file)}")
-            else:
-                self.update_expbar(self.expfiles)
+                spectra.append(self.cache.load(irras_angle.parse_exp, file))
+            except ValueError as err:
+                raise ValueError(file) from err
+        return spectra
+
+    def exp_loaded(self, expfiles, spectra, error):
+        if error is not None:
+            tk.messagebox.showerror("Error", "Invalid experimental file: "
+                                             f"{basename(str(error))}")
+            self.update_expbar(getattr(self, "expfiles", None))
+            return
+        self.expfiles = expfiles
+        # Sorted by wavenumber for decimating them, which doesn't matter for
+        # fitting as the spectra are resampled anyway.
+        orders = [np.argsort(x, kind="stable") for x, _ in spectra]
+        self.x_exp = [x[order] for (x, _), order in zip(spectra, orders)]
+        self.y_exp = [irras_angle.norm_spec(y)[order]
+                      for (_, y), order in zip(spectra, orders)]
+        self.update_expbar(self.expfiles)
+        self.draw_graph()
 
     def get_calc(self):
-        self.calcfile = tk.filedialog.askopenfilename()
+        calcfile = tk.filedialog.askopenfilename()
         # see above
-        if self.calcfile:
-            # see above
+        if calcfile:
+            self.stop_follow()
+            self.status_var_calc.set(f"Parsing '{basename(calcfile)}' ...")
+            self.worker.submit("calc", lambda result, error: self.calc_loaded(
+                calcfile, result, error), self.cache.load,
+                irras_angle.parse_outfile, calcfile)
+
+    def calc_loaded(self, calcfile, spectrum, error):
+        if error is not None:
+            tk.messagebox.showerror("Error", "Invalid ORCA output file")
+            self.update_calcbar(getattr(self, "calcfile", None))
+            return
+        self.calcfile = calcfile
+        self.ensemble = None
+        self.set_calc_spectrum(spectrum)
+        self.update_calcbar(self.calcfile)
+        self.draw_graph()
+
+    def get_ensemble(self):
+        # All outputs of the ensemble are parsed in parallel and their sticks
+        # are combined into a single spectrum with Boltzmann weights.
+        calcfiles = tk.filedialog.askopenfilenames()
+        if calcfiles:
+            self.stop_follow()
             try:
-                self.wn, self.t2, self.x_pol, self.y_pol, self.z_pol = \
-                    irras_angle.parse_outfile(self.calcfile)
-                self.draw_graph()
+                temperature = float(self.temperature_entry.get())
             except ValueError:
-                tk.messagebox.showerror("Error", "Invalid ORCA output file")
-            else:
-                self.update_calcbar(self.calcfile)
+                tk.messagebox.showerror("Error", "Invalid temperature")
+                return
+            self.status_var_calc.set(f"Parsing {len(calcfiles)} ORCA outputs ...")
+            self.worker.submit("calc", lambda result, error: self.ensemble_loaded(
+                calcfiles, temperature, result, error), irras_angle.parse_ensemble,
+                calcfiles, temperature, 1, None, self.cache, PROCESS_CONTEXT)
+
+    def ensemble_loaded(self, calcfiles, temperature, ensemble, error):
+        if error is not None:
+            tk.messagebox.showerror("Error", str(error))
+            self.update_calcbar(getattr(self, "calcfile", None))
+            return
+        self.calcfile = calcfiles
+        self.ensemble = ensemble
+        self.temperature = temperature
+        self.set_calc_spectrum(ensemble.spectrum)
+        self.update_calcbar(self.calcfile)
+        self.draw_graph()
+
+    def get_follow(self):
+        # The output is checked every FOLLOW_INTERVAL and only what was
+        # appended since the last check is read. Every new IR spectrum block
+        # replaces the calculated spectrum until another file is opened.
+        calcfile = tk.filedialog.askopenfilename()
+        if calcfile:
+            self.stop_follow()
+            self.worker.cancel("calc")
+            self.follower = irras_follow.OutfileFollower(calcfile)
+            self.status_var_calc.set(f"Following '{basename(calcfile)}', "
+                                     "waiting for the IR spectrum ...")
+            self.poll_follower()
+
+    def poll_follower(self):
+        try:
+            spectrum = self.follower.poll()
+        except OSError:
+            # E.g. the file being moved in between, the next poll starts over.
+            spectrum = None
+        if spectrum is not None:
+            self.calc_loaded(self.follower.path, spectrum, None)
+            self.status_var_calc.set(f"Following '{basename(self.follower.path)}', "
+                                     "IR spectrum loaded")
+        if self.follower.finished and not self.follower.behind:
+            if self.follower.spectrum is None:
+                tk.messagebox.showerror("Error", "ORCA job finished without an IR "
+                                                 "spectrum")
+            self.stop_follow()
+            self.update_calcbar(getattr(self, "calcfile", None))
+            return
+        # More than a single poll reads is left, so go on right away.
+        self.follow_job = self.after(0 if self.follower.behind else FOLLOW_INTERVAL,
+                                     self.poll_follower)
+
+    def stop_follow(self):
+        if self.follow_job is not None:
+            self.after_cancel(self.follow_job)
+        self.follower = None
+        self.follow_job = None
+
+    def get_store(self):
+        # Opening a store only reads its index. The entries are listed in a
+        # separate window and the selected ones are plotted.
+        directory = tk.filedialog.askdirectory()
+        if not directory:
+            return
+        try:
+            store = SpectrumStore(directory)
+        except (ValueError, SystemExit):
+            tk.messagebox.showerror("Error", "Invalid spectrum store")
+            return
+        for line in self.store_lines.values():
+            line.remove()
+        self.store_lines = {}
+        self.store = store
+
+        window = tk.Toplevel(self.master)
+        window.title(f"Spectrum store: {basename(directory)} "
+                     f"({len(store)} entries)")
+        scrollbar = tk.Scrollbar(window)
+        listbox = tk.Listbox(window, selectmode=tk.EXTENDED, width=60,
+                             height=20, yscrollcommand=scrollbar.set)
+        scrollbar.config(command=listbox.yview)
+        listbox.insert(tk.END, *(basename(name) for name in store.names))
+        plot_button = tk.Button(window, text="Plot", command=lambda: self.plot_stored(
+            store, listbox.curselection()))
+        plot_button.pack(side=tk.BOTTOM, pady=5)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        listbox.pack(side=tk.LEFT, fill="both", expand=True)
+
+    def plot_stored(self, store, rows):
+        if store is not self.store:
+            return
+        for row in list(self.store_lines):
+            if row not in rows:
+                self.store_lines.pop(row).remove()
+        for row in rows:
+            if row not in self.store_lines:
+                self.store_lines[row], = self.ax.plot(
+                    [], [], linestyle="--", label=basename(store.names[row]))
+        self.draw_graph()
+
+    def draw_stored(self):
+        # Only the part of the entries within the x range is read.
+        for row, line in self.store_lines.items():
+            line.set_data(*self.store.spectrum(row, self.xmin, self.xmax))
+
+    def set_calc_spectrum(self, spectrum):
+        self.calc_spectrum = spectrum
+        self.wn, self.t2 = spectrum.wn, spectrum.t_sq
+        self.dipoles = spectrum.dipoles
+        # The intensities don't depend on any parameter and are a view of the
+        # spectrum. Changing the scale factor just moves the sticks.
+        self.intensities = spectrum.intensities
+        # The file may have changed since it was broadened last.
+        self.broadened.clear()
+        self.calc_key = None
+
+    def reweight_ensemble(self):
+        # Combines the conformers again if the temperature was changed. The
+        # outputs are not parsed again for this.
+        temperature = float(self.temperature_entry.get())
+        if temperature != self.temperature:
+            weights = irras_angle.boltzmann_weights(
+                [spectrum.energy for spectrum in self.ensemble.spectra], temperature)
+            self.set_calc_spectrum(irras_angle.combine_spectra(self.ensemble.spectra,
+                                                               weights))
+            self.temperature = temperature
+            self.update_calcbar(self.calcfile)
 
     def update_expbar(self, pathtuple=None):
         # Default to pathtuple=None to reset status bar, e.g. after
@@ -99,8 +431,11 @@ class MainApplication(tk.Frame):
             self.status_var_exp.set("No experimental spectrum loaded")
 
     def update_calcbar(self, path=None):
-        # see above
-        if path:
+        # see above. Conformer ensembles are given as tuple of paths.
+        if isinstance(path, tuple):
+            self.status_var_calc.set(f"Ensemble of {len(path)} ORCA outputs loaded "
+                                     f"(T = {self.temperature:g} K)")
+        elif path:
             self.status_var_calc.set(f"""ORCA output '{basename(path)}' loaded""")
         else:
             self.status_var_calc.set("No ORCA output loaded")
@@ -153,40 +488,64 @@ class MainApplication(tk.Frame):
         self.scalefactor_entry = tk.Entry(
             textvariable=self.scalefactor_default, master=root)
 
+        self.temperature_label = tk.Label(text="Temperature / K", master=root)
+        self.temperature_default = tk.StringVar(value="298.15", master=root)
+        self.temperature_entry = tk.Entry(textvariable=self.temperature_default,
+                                          master=root)
+
         self.npoints_label = tk.Label(text="# of Points", master=root)
         self.npoints_default = tk.StringVar(value="", master=root)
         self.npoints_entry = tk.Entry(textvariable=self.npoints_default,
                                       master=root)
 
+        self.lineshape_label = tk.Label(text="Lineshape", master=root)
+        self.lineshape_default = tk.StringVar(value="gaussian", master=root)
+        self.lineshape_menu = tk.OptionMenu(root, self.lineshape_default,
+                                            *irras_angle.LINESHAPES)
+
+        self.sliders = {name: self.create_slider(root, name, *options)
+                        for name, *options in SLIDERS}
+
         self.draw_x = tk.BooleanVar()
         self.draw_x.set(False)
         self.draw_x_checkbox = tk.Checkbutton(text="x", var=self.draw_x,
+                                              command=self.update_components,
                                               master=root)
 
         self.draw_y = tk.BooleanVar()
         self.draw_y.set(False)
         self.draw_y_checkbox = tk.Checkbutton(text="y", var=self.draw_y,
+                                              command=self.update_components,
                                               master=root)
 
         self.draw_z = tk.BooleanVar()
         self.draw_z.set(False)
         self.draw_z_checkbox = tk.Checkbutton(text="z", var=self.draw_z,
+                                              command=self.update_components,
                                               master=root)
 
         self.draw_tot = tk.BooleanVar()
         self.draw_tot.set(True)
         self.draw_tot_checkbox = tk.Checkbutton(text="Total",
-                                                var=self.draw_tot, master=root)
+                                                var=self.draw_tot,
+                                                command=self.update_components,
+                                                master=root)
+        self.component_vars = {"tot": self.draw_tot, "x": self.draw_x,
+                               "y": self.draw_y, "z": self.draw_z}
 
         self.invert_x = tk.BooleanVar()
         self.invert_x.set(True)
         self.invert_x_checkbox = tk.Checkbutton(text="Invert x-axis",
-                                                var=self.invert_x, master=root)
+                                                var=self.invert_x,
+                                                command=self.update_view,
+                                                master=root)
 
         self.invert_y = tk.BooleanVar()
         self.invert_y.set(False)
         self.invert_y_checkbox = tk.Checkbutton(text="Invert y-axis",
-                                                var=self.invert_y, master=root)
+                                                var=self.invert_y,
+                                                command=self.update_view,
+                                                master=root)
 
         self.clear_exp_button = tk.Button(text="Clear Exp",
                                           command=self.clear_exp, master=root)
@@ -195,6 +554,14 @@ class MainApplication(tk.Frame):
 
         self.draw_button = tk.Button(text="Draw", command=self.draw_graph,
                                      master=root)
+        self.fit_button = tk.Button(text="Fit", command=self.fit_graph,
+                                    master=root)
+        self.optimize_button = tk.Button(text="Optimize parameters",
+                                         command=self.optimize_params, master=root)
+        self.anglemap_button = tk.Button(text="Angle map",
+                                         command=self.show_anglemap, master=root)
+        self.peaks_button = tk.Button(text="Assign peaks",
+                                      command=self.assign_peaks, master=root)
 
         # Placement of widgets happens here. self.row_counter is there to make adding,
         # removing or moving widgets in the grid less of a pain. Kinda ugly though.
@@ -207,11 +574,19 @@ class MainApplication(tk.Frame):
         self.xmin_entry.grid(row=self.row_counter, column=2, columnspan=2, padx=20, pady=5)
         self.row_counter += 1
 
+        self.sliders["xmin"].grid(row=self.row_counter, column=0, columnspan=5,
+                                  padx=20, sticky="ew")
+        self.row_counter += 1
+
         self.xmax_label.grid(row=self.row_counter, column=0, columnspan=2, padx=5, pady=5,
                              sticky="e")
         self.xmax_entry.grid(row=self.row_counter, column=2, columnspan=2, padx=20, pady=5)
         self.row_counter += 1
 
+        self.sliders["xmax"].grid(row=self.row_counter, column=0, columnspan=5,
+                                  padx=20, sticky="ew")
+        self.row_counter += 1
+
         self.exp_opt_label.grid(row=self.row_counter, columnspan=4, pady=(20, 0), sticky="w")
         self.row_counter += 1
 
@@ -221,6 +596,10 @@ class MainApplication(tk.Frame):
                                  pady=5)
         self.row_counter += 1
 
+        self.sliders["baseline"].grid(row=self.row_counter, column=0, columnspan=5,
+                                      padx=20, sticky="ew")
+        self.row_counter += 1
+
         self.calc_opt_label.grid(row=self.row_counter, columnspan=4, pady=(20, 0), sticky="w")
         self.row_counter += 1
 
@@ -230,17 +609,37 @@ class MainApplication(tk.Frame):
                                   pady=5)
         self.row_counter += 1
 
+        self.sliders["linewidth"].grid(row=self.row_counter, column=0, columnspan=5,
+                                       padx=20, sticky="ew")
+        self.row_counter += 1
+
         self.scalefactor_label.grid(row=self.row_counter, column=0, columnspan=2, padx=5,
                                     pady=5, sticky="e")
         self.scalefactor_entry.grid(row=self.row_counter, column=2, columnspan=2, padx=20,
                                     pady=5)
         self.row_counter += 1
 
+        self.sliders["scalefactor"].grid(row=self.row_counter, column=0, columnspan=5,
+                                         padx=20, sticky="ew")
+        self.row_counter += 1
+
+        self.temperature_label.grid(row=self.row_counter, column=0, columnspan=2, padx=5,
+                                    pady=5, sticky="e")
+        self.temperature_entry.grid(row=self.row_counter, column=2, columnspan=2, padx=20,
+                                    pady=5)
+        self.row_counter += 1
+
         self.npoints_label.grid(row=self.row_counter, column=0, columnspan=2, padx=5, pady=5,
                                 sticky="e")
         self.npoints_entry.grid(row=self.row_counter, column=2, columnspan=2, padx=20, pady=5)
         self.row_counter += 1
 
+        self.lineshape_label.grid(row=self.row_counter, column=0, columnspan=2, padx=5,
+                                  pady=5, sticky="e")
+        self.lineshape_menu.grid(row=self.row_counter, column=2, columnspan=2, padx=20,
+                                 pady=5)
+        self.row_counter += 1
+
         self.draw_x_checkbox.grid(row=self.row_counter, column=0)
         self.draw_y_checkbox.grid(row=self.row_counter, column=1)
         self.draw_z_checkbox.grid(row=self.row_counter, column=2)
@@ -257,12 +656,103 @@ class MainApplication(tk.Frame):
                                     pady=20)
         self.row_counter += 1
 
-        self.draw_button.grid(row=self.row_counter, column=0, columnspan=4, pady=30)
+        self.draw_button.grid(row=self.row_counter, column=0, columnspan=2, pady=30)
+        self.fit_button.grid(row=self.row_counter, column=3, columnspan=2, pady=30)
+        self.row_counter += 1
+
+        self.optimize_button.grid(row=self.row_counter, column=0, columnspan=2)
+        self.anglemap_button.grid(row=self.row_counter, column=3, columnspan=2)
+        self.row_counter += 1
+
+        self.peaks_button.grid(row=self.row_counter, column=0, columnspan=2, pady=10)
         self.row_counter += 1
 
+    def create_slider(self, root, name, start, stop, resolution, fmt):
+        # Sliders are an alternative to typing into the entries. The entry
+        # keeps the value that is actually used.
+        slider = tk.Scale(master=root, from_=start, to=stop, resolution=resolution,
+                          orient=tk.HORIZONTAL, showvalue=False,
+                          command=lambda value: self.slider_moved(name, value, fmt))
+        slider.bind("<ButtonPress-1>",
+                    lambda event: self.begin_live(blit=name in BLIT_SLIDERS))
+        slider.bind("<ButtonRelease-1>", lambda event: self.end_live())
+        return slider
+
+    def sync_sliders(self):
+        # Moves the sliders to the values of the entries, e.g. after typing
+        # into them or optimizing.
+        for name, slider in self.sliders.items():
+            try:
+                slider.set(float(getattr(self, f"{name}_default").get()))
+            except ValueError:
+                continue
+            # The slider rounds to its resolution and runs its command later
+            # on, which must not overwrite the entry.
+            self.synced[name] = slider.get()
+
+    def slider_moved(self, name, value, fmt):
+        value = fmt.format(float(value))
+        if name in self.synced and value == fmt.format(self.synced.pop(name)):
+            return
+        getattr(self, f"{name}_default").set(value)
+        if self.live_job is None:
+            self.live_job = self.after(LIVE_INTERVAL, self.live_update)
+
+    def live_update(self):
+        self.live_job = None
+        if not hasattr(self, "expfiles") and not hasattr(self, "calcfile"):
+            return
+        if int(self.xmin_entry.get()) >= int(self.xmax_entry.get()):
+            return
+        self.draw_graph(sync=False)
+
+    def begin_live(self, blit):
+        # While dragging, only the artists that change are redrawn onto a
+        # saved copy of the axis. Ticks, legend and layout are updated once
+        # the slider is released.
+        self.dragging = True
+        if not blit or not (self.exp_lines or self.calc_lines):
+            return
+        self.remove_overlays()
+        self.update_legend()
+        for artist in self.live_artists():
+            artist.set_animated(True)
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+
+    def end_live(self):
+        if not self.dragging:
+            return
+        self.dragging = False
+        self.background = None
+        for artist in self.live_artists():
+            artist.set_animated(False)
+        if self.live_job is not None:
+            self.after_cancel(self.live_job)
+            self.live_job = None
+        if hasattr(self, "expfiles") or hasattr(self, "calcfile"):
+            self.draw_graph(sync=False)
+
+    def live_artists(self):
+        return [*self.exp_lines.values(), *self.calc_lines.values(),
+                *self.calc_fills.values()]
+
+    def blit(self):
+        with irras_timing.stage("draw", blit=True):
+            self.canvas.restore_region(self.background)
+            for artist in self.live_artists():
+                if artist.get_visible():
+                    self.ax.draw_artist(artist)
+            self.canvas.blit(self.ax.bbox)
+
     def draw_canvas(self, root):
         # Create matplotlib figure and axis and put it on canvas
-        self.fig, self.ax = plt.subplots(figsize=(10, 7))
+        # The figure is created directly instead of through pyplot, which
+        # would manage a window of its own.
+        self.fig = Figure(figsize=(10, 7))
+        self.ax = self.fig.add_subplot()
+        self.ax.set_xlabel("Wavenumber", weight="bold")
+        self.ax.set_ylabel("Intensity / a.u.", weight="bold")
         self.canvas = FigureCanvasTkAgg(self.fig, master=root)
         self.canvas.get_tk_widget().pack(side=tk.BOTTOM, fill="both",
                                          expand=True, padx=10, pady=5)
@@ -270,91 +760,371 @@ class MainApplication(tk.Frame):
         self.toolbar.update()
         self.canvas.get_tk_widget().pack(side=tk.BOTTOM, fill="both",
                                          expand=True)
+        # Experimental spectra are decimated for the current view, which
+        # changes when zooming, panning or resizing the window.
+        self.ax.callbacks.connect("xlim_changed", lambda ax: self.decimate_exp())
+        self.canvas.mpl_connect("resize_event", lambda event: self.decimate_exp())
 
-    def draw_graph(self):
+    def draw_graph(self, then=None, sync=True):
         # Wrapper function for draw_calc and draw_exp which handle the actual drawing.
-        # Logic when to draw what goes here. Includes cleanup of axis when called to
-        # make multiple calls in one session more convenient.
-        self.ax.clear()
+        # Logic when to draw what goes here. The axis is not cleared, instead the
+        # existing artists get new data where it changed. As broadening happens in
+        # the worker thread, then is called once everything has been drawn.
         self.xmin, self.xmax = int(self.xmin_entry.get()),\
                                int(self.xmax_entry.get())
+        if sync:
+            self.sync_sliders()
 
         # This seemed more straightforward than doing this with exceptions in
         # attempt to comply with the IEAPF paradigm
+        if not hasattr(self, "expfiles") and not hasattr(self, "calcfile") \
+                and not self.store_lines:
+            tk.messagebox.showerror("Error", "No file loaded for plotting")
+            return
+        self.remove_overlays()
         if hasattr(self, "expfiles"):
             self.draw_exp()
+        self.draw_stored()
         if hasattr(self, "calcfile"):
-            self.draw_calc()
-        if not hasattr(self, "expfiles") and not hasattr(self, "calcfile"):
-            tk.messagebox.showerror("Error", "No file loaded for plotting")
+            self.draw_calc(then)
         else:
-            self.ax.set_xlabel("Wavenumber", weight="bold")
-            self.ax.set_ylabel("Intensity / a.u.", weight="bold")
-            plt.xlim(self.xmin, self.xmax)
+            self.finish_graph(then)
+
+    def finish_graph(self, then=None):
+        if self.background is not None:
+            self.blit()
+        elif self.dragging:
+            # The x range changes, so the axis is redrawn but the layout is
+            # left alone until the slider is released.
+            self.update_view()
+        else:
+            self.fig.tight_layout()
+            self.update_view()
+        if then is not None:
+            then()
+
+    def update_view(self):
+        # Applies axis limits, inversion and legend to the current artists
+        # and schedules a redraw of the canvas. Nothing is recomputed here.
+        self.ax.relim(visible_only=True)
+        self.ax.autoscale_view(scalex=False)
+        if hasattr(self, "xmin"):
             if self.invert_x.get():
-                self.ax.invert_xaxis()
-            if self.invert_y.get():
-                self.ax.invert_yaxis()
-            self.ax.legend()
-            plt.tight_layout()
-            self.canvas.draw()
+                self.ax.set_xlim(self.xmax, self.xmin)
+            else:
+                self.ax.set_xlim(self.xmin, self.xmax)
+        if self.invert_y.get() != self.ax.yaxis_inverted():
+            self.ax.invert_yaxis()
+        self.update_legend()
+        if irras_timing.enabled:
+            # Drawing right away instead of when idle so that it can be timed.
+            with irras_timing.stage("draw"):
+                self.canvas.draw()
+        else:
+            self.canvas.draw_idle()
+
+    def update_legend(self):
+        handles = [artist for artist in (*self.exp_lines.values(),
+                                         *self.calc_lines.values(),
+                                         *self.store_lines.values(),
+                                         *self.overlay_lines)
+                   if artist.get_visible()]
+        if handles:
+            self.ax.legend(handles=handles)
+        elif self.ax.get_legend():
+            self.ax.get_legend().remove()
+
+    def remove_overlays(self):
+        # Fitted and best orientation spectra are only valid for the parameters
+        # they were computed with.
+        for line in self.overlay_lines:
+            line.remove()
+        self.overlay_lines = []
 
     def draw_exp(self):
-        # self.y_exp = irras_angle.norm_spec(self.y_exp)
-        # self.y_exp_shift = np.add(self.y_exp, float(self.baseline_entry.get()))
-        # self.exp_curve = self.ax.plot(self.x_exp, self.y_exp_shift,
-        #                               linewidth=2, label="Exp. Spectrum")
-        self.y_exp = [irras_angle.norm_spec(spec) for spec in self.y_exp]
         self.y_exp_shift = [np.add(y, float(self.baseline_entry.get())) for y in self.y_exp]
-        self.exp_curves = [self.ax.plot(x, y, linewidth=2, label=f"{basename(file)}") for (x, y, file) in zip(self.x_exp, self.y_exp_shift, self.expfiles)]
-        # self.exp_curve = []
-        # for x, y, basename in zip(self.x_exp, self.y_exp_shift, self.basenames):
-        #     self.exp_curve.append(self.ax.plot(x, y, linewidth=2, label=f"{basename}"))
+        for file in list(self.exp_lines):
+            if file not in self.expfiles:
+                self.exp_lines.pop(file).remove()
+        for file in self.expfiles:
+            if file not in self.exp_lines:
+                self.exp_lines[file], = self.ax.plot([], [], linewidth=2,
+                                                     label=f"{basename(file)}")
+        self.exp_view = None
+        self.decimate_exp((self.xmin, self.xmax))
+
+    def decimate_exp(self, xlim=None):
+        # Only a few points per pixel column of the visible part of the
+        # experimental spectra are drawn, the full spectra are kept in
+        # self.x_exp and self.y_exp_shift.
+        if not self.exp_lines:
+            return
+        x_lo, x_hi = sorted(xlim or self.ax.get_xlim())
+        view = (x_lo, x_hi, max(int(self.ax.bbox.width), 1))
+        if view == self.exp_view:
+            return
+        self.exp_view = view
+        for x, y, file in zip(self.x_exp, self.y_exp_shift, self.expfiles):
+            self.exp_lines[file].set_data(irras_angle.decimate(x, y, *view))
 
-    def draw_calc(self):
+    def get_grid(self):
+        # Defaults to one point every 4 wavenumbers if no number of points was
+        # given.
         if not self.npoints_entry.get():
-            self.x_calc = np.linspace(self.xmin, self.xmax,
-                                      int((self.xmax - self.xmin) / 4))
+            return np.linspace(self.xmin, self.xmax, int((self.xmax - self.xmin) / 4))
+        return np.linspace(self.xmin, self.xmax, int(self.npoints_entry.get()))
+
+    def draw_calc(self, then=None):
+        if self.ensemble is not None:
+            try:
+                self.reweight_ensemble()
+            except ValueError:
+                tk.messagebox.showerror("Error", "Invalid temperature")
+                return
+        key = (self.calcfile, float(self.scalefactor_entry.get()),
+               float(self.linewidth_entry.get()), self.lineshape_default.get(),
+               self.npoints_entry.get(), self.xmin, self.xmax)
+        if key in self.broadened:
+            self.broadened.move_to_end(key)
+            self.show_broadened(key)
+            self.finish_graph(then)
+            return
+
+        # Everything needed is collected here as Tk must only be touched by
+        # the main thread.
+        _, scalefactor, linewidth, lineshape, _, _, _ = key
+        self.status_var_calc.set("Broadening calculated spectrum ...")
+        self.worker.submit("broaden", lambda result, error: self.calc_broadened(
+            key, result, error, then), broaden, self.get_grid(),
+            np.multiply(self.wn, scalefactor),
+            self.intensities, linewidth, lineshape)
+
+    def calc_broadened(self, key, result, error, then=None):
+        self.update_calcbar(getattr(self, "calcfile", None))
+        # The calc file may have been closed or replaced in the meantime.
+        if key[0] != getattr(self, "calcfile", None):
+            return
+        if error is not None:
+            message = str(error) or type(error).__name__
+            tk.messagebox.showerror("Error", "Broadening failed with the current "
+                                             f"parameters: {message}")
+            return
+        self.broadened[key] = result
+        if len(self.broadened) > BROADENED_MEMO_SIZE:
+            self.broadened.popitem(last=False)
+        self.show_broadened(key)
+        self.finish_graph(then)
+
+    def show_broadened(self, key):
+        # All channels are normalized by the maximum of Tot to ensure that
+        # x,y,z are scaled properly w.r.t Tot. Just normalizing each will not
+        # work here. That happens only once per memoized spectrum.
+        self.broadened_spectrum = self.broadened[key]
+        self.x_calc = self.broadened_spectrum.x
+
+        if key != self.calc_key:
+            self.calc_key = key
+            for name in list(self.calc_lines):
+                self.set_component_data(name)
+        self.show_components()
+
+    def set_component_data(self, name):
+        # Creates or updates line (and fill) of a component of the calculated
+        # spectrum from the current broadened spectra.
+        _, channel, color, linewidth, label = next(
+            component for component in CALC_COMPONENTS if component[0] == name)
+        y = self.broadened_spectrum.normalized[channel]
+        if name in self.calc_lines:
+            self.calc_lines[name].set_data(self.x_calc, y)
         else:
-            self.x_calc = np.linspace(self.xmin, self.xmax,
-                                      int(self.npoints_entry.get()))
-        self.wn_scaled = np.multiply(self.wn,
-                                     float(self.scalefactor_entry.get()))
-
-        self.y4 = irras_angle.broaden_spec(self.x_calc, self.wn_scaled,
-                                           self.t2,
-                                           float(self.linewidth_entry.get()))
-        # This is needed to ensure that x,y,z are scaled properly w.r.t Tot.
-        # Just normalizing each will not work here.
-        self.norm_factor = np.amax(self.y4)
-
-        if self.draw_tot.get():
-            self.y4_curve = self.ax.plot(self.x_calc, irras_angle.norm_spec(self.y4),
-                                         "k", linewidth=2, label="Total Calc. Spectrum")
-        if self.draw_x.get():
-            self.y1 = irras_angle.broaden_spec(self.x_calc, self.wn_scaled,
-                                               self.x_pol,
-                                               float(self.linewidth_entry.get()))
-            self.ax.plot(self.x_calc, np.divide(self.y1, self.norm_factor),
-                         "b", linewidth=1, label="x-pol. Calc. Spectrum")
-            plt.fill_between(self.x_calc, np.divide(self.y1, self.norm_factor),
-                             alpha=0.3)
-        if self.draw_y.get():
-            self.y2 = irras_angle.broaden_spec(self.x_calc, self.wn_scaled,
-                                               self.y_pol,
-                                               float(self.linewidth_entry.get()))
-            self.ax.plot(self.x_calc, np.divide(self.y2, self.norm_factor),
-                         "r", linewidth=1, label="y-pol. Calc. Spectrum")
-            plt.fill_between(self.x_calc, np.divide(self.y2, self.norm_factor),
-                             alpha=0.3)
-        if self.draw_z.get():
-            self.y3 = irras_angle.broaden_spec(self.x_calc, self.wn_scaled,
-                                               self.z_pol,
-                                               float(self.linewidth_entry.get()))
-            self.ax.plot(self.x_calc, np.divide(self.y3, self.norm_factor),
-                         "y", linewidth=1, label="z-pol. Calc. Spectrum")
-            plt.fill_between(self.x_calc, np.divide(self.y3, self.norm_factor),
-                             alpha=0.3)
+            self.calc_lines[name], = self.ax.plot(self.x_calc, y, color,
+                                                  linewidth=linewidth, label=label)
+        if name != "tot":
+            # Same polygon as fill_between(x, y) creates, which is a lot slower.
+            if name in self.calc_fills:
+                self.calc_fills[name].set_verts([np.concatenate(
+                    ([[self.x_calc[0], 0]], np.column_stack((self.x_calc, y)),
+                     [[self.x_calc[-1], 0]]))])
+            else:
+                self.calc_fills[name] = self.ax.fill_between(self.x_calc, y,
+                                                             color=color, alpha=0.3)
+
+    def show_components(self):
+        # Shows the artists of the checked components and hides the others.
+        # Components drawn for the first time are created from the memoized
+        # broadened spectra.
+        for name, *_ in CALC_COMPONENTS:
+            visible = self.component_vars[name].get()
+            if visible and name not in self.calc_lines:
+                self.set_component_data(name)
+            if name in self.calc_lines:
+                self.calc_lines[name].set_visible(visible)
+            if name in self.calc_fills:
+                self.calc_fills[name].set_visible(visible)
+
+    def update_components(self):
+        # Called by the component checkboxes. Toggling a component only
+        # changes the visibility of its artists.
+        if self.calc_key is not None:
+            self.show_components()
+            self.update_view()
+
+    def fit_graph(self):
+        # Fits the x-, y- and z-polarized components to the first experimental
+        # spectrum. The graph is redrawn first so that the broadened components
+        # and the experimental spectrum match the current parameters.
+        if not hasattr(self, "expfiles") or not hasattr(self, "calcfile"):
+            tk.messagebox.showerror("Error", "Fitting requires both an experimental "
+                                             "spectrum and an ORCA output")
+            return
+        self.draw_graph(then=self.draw_fit)
+
+    def draw_fit(self):
+        try:
+            weights, self.y_fit = irras_angle.fit_spec(
+                self.x_calc, self.broadened_spectrum.normalized[:3],
+                self.x_exp[0], self.y_exp_shift[0])
+        except ValueError:
+            tk.messagebox.showerror("Error", "Experimental and calculated spectra "
+                                             "do not overlap")
+            return
+        self.fit_curve, = self.ax.plot(self.x_calc, self.y_fit, "g", linewidth=2,
+                                       label="Fitted spectrum with\n"
+                                             f"{weights[0]:.2f} {weights[1]:.2f} "
+                                             f"{weights[2]:.2f}")
+        self.overlay_lines.append(self.fit_curve)
+        self.update_view()
+
+    def optimize_params(self):
+        # Searches scale factor, linewidth and baseline shift for the best
+        # agreement with the first experimental spectrum, puts the results
+        # into the entries and redraws.
+        if not hasattr(self, "expfiles") or not hasattr(self, "calcfile"):
+            tk.messagebox.showerror("Error", "Optimizing requires both an "
+                                             "experimental spectrum and an ORCA output")
+            return
+        self.xmin, self.xmax = int(self.xmin_entry.get()), int(self.xmax_entry.get())
+        self.status_var_calc.set("Optimizing parameters ...")
+        self.worker.submit("optimize", self.optimized, irras_angle.optimize_params,
+                           self.get_grid(), self.wn, self.t2, self.x_exp[0],
+                           self.y_exp[0], (0.9, 1.05, 16), (5, 30, 11),
+                           self.lineshape_default.get(), None, PROCESS_CONTEXT)
+
+    def optimized(self, result, error):
+        self.update_calcbar(getattr(self, "calcfile", None))
+        if error is not None:
+            # Spectra that do not overlap are reported by optimize_params
+            # itself as such.
+            message = str(error) or type(error).__name__
+            tk.messagebox.showerror("Error", f"Optimization failed: {message}")
+            return
+        self.scalefactor_default.set(f"{result.scalefactor:.4f}")
+        self.linewidth_default.set(f"{result.linewidth:.2f}")
+        self.baseline_default.set(f"{result.baselineshift:.4f}")
+        self.draw_graph()
+        tk.messagebox.showinfo(
+            "Optimization", f"Mean squared deviation: {result.deviation:.3e}\n"
+                            f"{result.evaluations} evaluations, "
+                            f"{result.time_per_eval * 1000:.2f} ms per evaluation, "
+                            f"{result.wall_time:.2f} s total")
+
+    def assign_peaks(self):
+        # Picks the peaks of the first experimental spectrum and assigns the
+        # calculated modes to them. The scale factor fitted to the pairs goes
+        # into the entry, the graph is redrawn with it and the assigned peaks
+        # are marked.
+        if not hasattr(self, "expfiles") or not hasattr(self, "calcfile"):
+            tk.messagebox.showerror("Error", "Assigning peaks requires both an "
+                                             "experimental spectrum and an ORCA output")
+            return
+        self.y_exp_shift = [np.add(y, float(self.baseline_entry.get())) for y in self.y_exp]
+        peak_x, peak_y = irras_angle.pick_peaks(self.x_exp[0], self.y_exp_shift[0])
+        try:
+            assignment = irras_angle.assign_peaks(
+                peak_x, self.wn, self.t2,
+                np.append(float(self.scalefactor_entry.get()),
+                          np.linspace(0.9, 1.05, 16)))
+        except ValueError:
+            tk.messagebox.showerror("Error", "No calculated mode is close to an "
+                                             "experimental peak")
+            return
+        self.scalefactor_default.set(f"{assignment.scalefactor:.4f}")
+        self.draw_graph(then=lambda: self.draw_peaks(assignment, peak_y, len(peak_x)))
+
+    def draw_peaks(self, assignment, peak_y, npeaks):
+        self.overlay_lines.extend(
+            self.ax.plot(assignment.exp, peak_y[assignment.peaks], "kv",
+                         label="Assigned peaks"))
+        self.update_view()
+        tk.messagebox.showinfo(
+            "Peak assignment", f"Assigned {len(assignment.exp)} of {npeaks} peaks\n"
+                               f"Scale factor: {assignment.scalefactor:.4f}\n"
+                               f"RMS deviation: {assignment.rmsd:.1f} cm**-1")
+
+    def show_anglemap(self):
+        # Opens a window showing the IRRAS spectrum as function of the tilt
+        # angle of the molecule (averaged over the azimuthal angle). If an
+        # experimental spectrum is loaded, the spectrum of the best fitting
+        # orientation is drawn into the main graph as well.
+        if not hasattr(self, "calcfile"):
+            tk.messagebox.showerror("Error", "No ORCA output loaded")
+            return
+        self.xmin, self.xmax = int(self.xmin_entry.get()), int(self.xmax_entry.get())
+        x_calc = self.get_grid()
+        thetas = np.arange(0, 91, 5)
+        phis = np.arange(0, 360, 15)
+        # Broadening all orientations takes a while, so it happens in the
+        # worker thread like all other broadening.
+        calcfile = self.calcfile
+        self.status_var_calc.set("Computing angle map ...")
+        self.worker.submit("anglemap", lambda result, error: self.anglemap_computed(
+            calcfile, x_calc, thetas, phis, result, error), irras_angle.angle_spectra,
+            x_calc, np.multiply(self.wn, float(self.scalefactor_entry.get())),
+            self.dipoles, thetas, phis, float(self.linewidth_entry.get()),
+            self.lineshape_default.get())
+
+    def anglemap_computed(self, calcfile, x_calc, thetas, phis, stack, error):
+        self.update_calcbar(getattr(self, "calcfile", None))
+        # The calc file may have been closed or replaced in the meantime.
+        if calcfile != getattr(self, "calcfile", None):
+            return
+        if error is not None:
+            message = str(error) or type(error).__name__
+            tk.messagebox.showerror("Error", f"Angle map failed: {message}")
+            return
+
+        window = tk.Toplevel(self.master)
+        window.title("Angle map")
+        fig = Figure(figsize=(8, 5))
+        ax = fig.add_subplot()
+        mesh = ax.pcolormesh(x_calc, thetas,
+                             stack.reshape(thetas.size, phis.size, -1).mean(axis=1)
+                             / np.amax(stack), shading="nearest")
+        fig.colorbar(mesh, ax=ax, label="Intensity / a.u.")
+        ax.set_xlabel("Wavenumber", weight="bold")
+        ax.set_ylabel("Tilt angle θ / °", weight="bold")
+        if self.invert_x.get():
+            ax.invert_xaxis()
+        fig.tight_layout()
+        canvas = FigureCanvasTkAgg(fig, master=window)
+        canvas.get_tk_widget().pack(fill="both", expand=True)
+        canvas.draw()
+
+        if hasattr(self, "expfiles"):
+            self.draw_graph(then=lambda: self.draw_orientation(x_calc, stack, thetas,
+                                                               phis))
+
+    def draw_orientation(self, x_calc, stack, thetas, phis):
+        try:
+            best, scale, _ = irras_angle.fit_angle(x_calc, stack, self.x_exp[0],
+                                                   self.y_exp_shift[0])
+        except ValueError:
+            return
+        theta, phi = thetas[best // phis.size], phis[best % phis.size]
+        self.overlay_lines.extend(
+            self.ax.plot(x_calc, stack[best] * scale, "m", linewidth=2,
+                         label=f"Best orientation\n(θ = {theta}°, φ = {phi}°)"))
+        self.update_view()
 
     def clear_exp(self):
         try:
@@ -363,34 +1133,41 @@ class MainApplication(tk.Frame):
         except AttributeError:
             pass
         else:
-            # Remove exp trace and have it garbage-collected
-            for curve in self.exp_curves:
-                curve.pop(0).remove()
-            self.ax.get_legend().remove()
-            # This is needed in case a calcfile is present, otherwise legend
-            # would indiscriminately be removed.
-            if hasattr(self, "calcfile"):
-                self.ax.legend()
-            self.canvas.draw()
+            # Remove exp traces and have them garbage-collected
+            for line in self.exp_lines.values():
+                line.remove()
+            self.exp_lines = {}
+            self.remove_overlays()
+            self.update_view()
 
     def clear_calc(self):
-        # It's easier to just redraw the graph from scratch if self.expfile is present than
-        # trying to remove every component of draw_calc() it seems.
+        # Only the artists of the calculated spectra are removed, everything
+        # else stays as it is.
+        if self.follower is not None:
+            self.stop_follow()
+            self.update_calcbar(getattr(self, "calcfile", None))
+        if self.store_lines:
+            for line in self.store_lines.values():
+                line.remove()
+            self.store_lines = {}
+            self.update_view()
         try:
             delattr(self, "calcfile")
             self.update_calcbar()
         except AttributeError:
             pass
         else:
-            if hasattr(self, "expfiles"):
-                # Implies clearing of ax which is called in the beginning of
-                # "draw_graph()"
-                self.draw_graph()
-            else:
-                # Can't just call draw_graph() because no data is present to be plotted
-                # giving an error message.
-                self.ax.clear()
-                self.canvas.draw()
+            for artist in (*self.calc_lines.values(), *self.calc_fills.values()):
+                artist.remove()
+            self.calc_lines = {}
+            self.calc_fills = {}
+            self.calc_key = None
+            self.broadened.clear()
+            self.ensemble = None
+            self.worker.cancel("broaden")
+            self.worker.cancel("anglemap")
+            self.remove_overlays()
+            self.update_view()
 
     def close_app(self):
         self.quit()
@@ -0,0 +1,246 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+import irras_angle
+import irras_batch
+from irras_store import SpectrumStore
+
+CHANNELS = ("total", "x", "y", "z")
+METRICS = ("cosine", "pearson")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(parents=[irras_angle.broadening_parser()],
+                                     description="""
+        Builds a library of calculated spectra broadened onto a common grid
+        and searches it for the entries most similar to an experimental
+        spectrum.""")
+    parser.add_argument("library", help="Library directory (spectrum store)")
+    parser.add_argument("-b", "--build", metavar="", nargs="+",
+                        help="Build the library from these ORCA output files, "
+                             "glob patterns or directories")
+    parser.add_argument("-q", "--query", metavar="",
+                        help="Search the library for the entries most similar "
+                             "to this experimental spectrum")
+    parser.add_argument("-l", "--list", action="store_true",
+                        help="Print the entries of the library")
+    parser.add_argument("-s", "--show", metavar="", nargs="+",
+                        help="Plot these entries of the library, given by "
+                             "name or number, together with the experimental "
+                             "spectrum given by --query if any")
+    parser.add_argument("-p", "--pattern", metavar="", default="*.out",
+                        help="Glob pattern for the files taken from "
+                             "directories (Default = *.out)")
+    parser.add_argument("-j", "--workers", metavar="", type=int, default=None,
+                        help="Number of worker processes for building "
+                             "(Default = number of CPUs)")
+    parser.add_argument("-ch", "--channel", metavar="", default="total",
+                        choices=CHANNELS,
+                        help="Component stored in the library: total, x, y "
+                             "or z (Default = total)")
+    parser.add_argument("-m", "--metric", metavar="", default="cosine",
+                        choices=METRICS,
+                        help="Similarity used for ranking: cosine or pearson, "
+                             "the latter ignores constant offsets "
+                             "(Default = cosine)")
+    parser.add_argument("-k", "--top", metavar="", type=int, default=10,
+                        help="Number of matches printed")
+    parser.add_argument("--sf-range", metavar="", type=float, nargs=3,
+                        default=[1, 1, 1],
+                        help="Minimum, maximum and number of scale factors "
+                             "scanned for every entry (Default = 1 1 1)")
+    return parser
+
+
+def broaden_file(path, x_calc, channel, linewidth, lineshape, scalefactor=1,
+                 engine="auto"):
+    """Returns path, the spectrum of normalized_component and the error if
+    there is one. Runs in the worker processes, errors are returned instead
+    of raised, see irras_batch.run_job.
+    """
+    row, error = irras_batch.run_job(normalized_component, path, x_calc,
+                                     channel, linewidth, lineshape,
+                                     scalefactor, engine)
+    return path, row, error
+
+
+def normalized_component(path, x_calc, channel, linewidth, lineshape,
+                         scalefactor=1, engine="auto"):
+    """Parses a single ORCA output and returns the requested component
+    broadened onto x_calc and normalized to a maximum of 1.
+    """
+    spectrum = irras_angle.parse_outfile(path, scalefactor)
+    sticks = {"total": spectrum.t_sq, "x": spectrum.x, "y": spectrum.y,
+              "z": spectrum.z}[channel]
+    row = irras_angle.broaden_spec(x_calc, spectrum.wn, sticks, linewidth,
+                                   lineshape, engine)
+    peak = np.amax(row)
+    if peak <= 0:
+        raise ValueError("Error! No intensity within the grid")
+    return (row / peak).astype(np.float32)
+
+
+def build_library(libdir, files, x_calc, channel="total", linewidth=15,
+                  lineshape="gaussian", scalefactor=1, engine="auto",
+                  workers=None):
+    """Broadens all files onto x_calc in parallel and appends the spectra to
+    a new spectrum store in libdir as they arrive, so the library never has
+    to fit into memory. Returns the number of stored entries and a list of
+    (file, error) for the files that failed.
+    """
+    failed = []
+    broaden = partial(broaden_file, x_calc=x_calc, channel=channel,
+                      linewidth=linewidth, lineshape=lineshape,
+                      scalefactor=scalefactor, engine=engine)
+    chunksize = max(1, len(files) // (4 * (workers or os.cpu_count())))
+    with SpectrumStore.create(libdir, x_calc, channel=channel,
+                              linewidth=linewidth, lineshape=lineshape,
+                              scalefactor=scalefactor) \
+            as store, ProcessPoolExecutor(max_workers=workers) as pool:
+        for path, row, error in pool.map(broaden, files, chunksize=chunksize):
+            if error:
+                failed.append((path, error))
+            else:
+                store.append(path, row)
+    return len(store.names), failed
+
+
+def find_entries(store, entries):
+    """Returns the row numbers of entries given by name or number.
+    """
+    rows = []
+    for entry in entries:
+        if entry in store.rows:
+            rows.append(store.rows[entry])
+        elif entry.isdigit() and int(entry) < len(store):
+            rows.append(int(entry))
+        else:
+            sys.exit(f"Error! Entry '{entry}' not found in library! "
+                     "Exiting ...")
+    return rows
+
+
+def show_entries(store, rows, expfile=None):
+    """Plots the given rows of the store, reading only those from disk.
+    """
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+    xmin, xmax = store.x[0], store.x[-1]
+    if expfile:
+        x_exp, y_exp = irras_angle.parse_exp(expfile)
+        ax.plot(x_exp, y_exp / np.amax(np.abs(y_exp)), color="black",
+                label="experiment")
+        xmin, xmax = max(xmin, np.amin(x_exp)), min(xmax, np.amax(x_exp))
+    for row in rows:
+        x, y = store.spectrum(row, xmin, xmax)
+        ax.plot(x, y, label=os.path.basename(store.names[row]))
+    ax.set_xlim(xmax, xmin)
+    ax.set_xlabel(r"$\tilde{\nu}$ / cm$^{-1}$")
+    ax.legend()
+    plt.show()
+
+
+def similarities(x_lib, matrix, x_exp, y_exp, scalefactors=(1,),
+                 metric="cosine"):
+    """Returns the similarity of every library entry (rows of matrix on the
+    grid x_lib) to the experimental spectrum for every scale factor as
+    (n_entries, len(scalefactors)) array. Scaling an entry by s is the same
+    as comparing it to the experiment stretched by 1/s, apart from the
+    linewidth, so the experiment is resampled once per scale factor and all
+    entries are compared at once by matrix products. Only the points covered
+    by the experiment count.
+    """
+    targets = np.array([irras_angle.resample(np.multiply(x_lib, scalefactor),
+                                             x_exp, y_exp)
+                        for scalefactor in scalefactors]).T
+    masks = ~np.isnan(targets)
+    if not masks.any(axis=0).all():
+        raise ValueError("Error! Experimental spectrum and library do not "
+                         "overlap")
+    targets = np.where(masks, targets, 0)
+    masks = masks.astype(np.float32)
+    squares = np.square(matrix) @ masks
+    counts = masks.sum(axis=0)
+
+    if metric == "pearson":
+        targets = np.where(masks > 0, targets - targets.sum(axis=0) / counts, 0)
+        means = (matrix @ masks) / counts
+        squares = squares - counts * np.square(means)
+    elif metric != "cosine":
+        raise ValueError(f"Error! Unknown similarity metric '{metric}'")
+    dots = matrix @ targets.astype(np.float32)
+    norms = np.sqrt(np.maximum(squares, 0)) * np.linalg.norm(targets, axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.nan_to_num(dots / norms)
+
+
+def top_matches(scores, k):
+    """Returns the indices of the k best entries, best first, and the index
+    of the best scale factor for each of them.
+    """
+    best = scores.max(axis=1)
+    k = min(k, len(best))
+    indices = np.argpartition(-best, k - 1)[:k]
+    indices = indices[np.argsort(-best[indices])]
+    return indices, scores[indices].argmax(axis=1)
+
+
+def main():
+    if not (args.build or args.query or args.list or args.show):
+        sys.exit("Error! One of --build, --query, --list or --show must be "
+                 "given! Exiting ...")
+    if args.build:
+        files = irras_batch.collect_files(args.build, args.pattern)
+        x_calc = np.linspace(args.xmin, args.xmax, args.npoints)
+        start = time.perf_counter()
+        stored, failed = build_library(args.library, files, x_calc,
+                                       args.channel, args.linewidth,
+                                       args.lineshape, args.scalefactor,
+                                       args.engine, args.workers)
+        for path, error in failed:
+            print(f"{os.path.basename(path)}: FAILED ({error})",
+                  file=sys.stderr)
+        print(f"Stored {stored} spectra ({len(failed)} failed) in "
+              f"{args.library} in {time.perf_counter() - start:.2f} s")
+
+    # Opening the store only reads the index, the spectra are memory-mapped.
+    store = SpectrumStore(args.library)
+    if args.list:
+        for row, name in enumerate(store.names):
+            print(f"{row:>6}  {name}")
+
+    if args.show:
+        show_entries(store, find_entries(store, args.show), args.query)
+    elif args.query:
+        start = time.perf_counter()
+        x_exp, y_exp = irras_angle.parse_exp(args.query)
+        scalefactors = np.linspace(args.sf_range[0], args.sf_range[1],
+                                   int(args.sf_range[2]))
+        # Only the grid points covered by the experiment for some scale factor
+        # count, so only those columns are read from the store.
+        columns = store.columns(np.amin(x_exp) / np.amax(scalefactors),
+                                np.amax(x_exp) / np.amin(scalefactors))
+        x_lib, names = store.x[columns], store.names
+        matrix = store.spectra[:, columns]
+        scores = similarities(x_lib, matrix, x_exp, y_exp, scalefactors,
+                              args.metric)
+        indices, sf_indices = top_matches(scores, args.top)
+        print(f"{'rank':>4} {args.metric:>10} {'scale':>7}  entry")
+        for rank, (index, sf_index) in enumerate(zip(indices, sf_indices),
+                                                 start=1):
+            print(f"{rank:>4} {scores[index, sf_index]:>10.4f} "
+                  f"{scalefactors[sf_index]:>7.4f}  {names[index]}")
+        print(f"Searched {len(names)} entries in "
+              f"{time.perf_counter() - start:.3f} s")
+
+
+if __name__ == "__main__":
+    args = parse_args().parse_args()
+    main()
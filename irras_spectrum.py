@@ -0,0 +1,159 @@
+import re
+
+import numpy as np
+
+# Name, index in the channels of BroadenedSpectrum, color, linewidth and label
+# of the components of the calculated spectrum as drawn by the GUI and
+# irras_export.py. All but the total are filled.
+CALC_COMPONENTS = [("tot", 3, "k", 2, "Total Calc. Spectrum"),
+                   ("x", 0, "b", 1, "x-pol. Calc. Spectrum"),
+                   ("y", 1, "r", 1, "y-pol. Calc. Spectrum"),
+                   ("z", 2, "y", 1, "z-pol. Calc. Spectrum")]
+# Markers of the IR spectrum block in ORCA outputs and the transition lines
+# inside of it, which start with the mode number followed by a colon.
+IR_BLOCK_START = b"IR SPECTRUM"
+IR_BLOCK_END = b"\n*"
+IR_ROW_PATTERN = re.compile(rb"^[ \t]*\d+:.*$", re.MULTILINE)
+# Line of ORCA outputs holding the total energy in Hartree.
+ENERGY_LINE = b"FINAL SINGLE POINT ENERGY"
+
+
+def _column(index, doc):
+    return property(lambda self: self.data[:, index], doc=doc)
+
+
+class StickSpectrum:
+    """Stick spectrum of an ORCA output as returned by
+    irras_angle.parse_outfile. All values are kept in a single
+    (n_modes, len(COLUMNS)) Fortran-ordered array, so every column is a
+    contiguous view of it and nothing is copied when accessing them. energy
+    is the final single point energy in Hartree (NaN if there is none).
+    """
+
+    # The x-, y-, z-polarized and total intensities come in the order of the
+    # channels of irras_angle.broaden_channels.
+    COLUMNS = ("wn", "x", "y", "z", "t_sq", "tx", "ty", "tz")
+    __slots__ = ("data", "energy")
+
+    def __init__(self, data, energy=np.nan):
+        self.data = np.asfortranarray(data, dtype=float)
+        if self.data.ndim != 2 or self.data.shape[1] != len(self.COLUMNS):
+            raise ValueError("Error! Invalid stick spectrum")
+        self.energy = float(energy)
+
+    @classmethod
+    def from_dipoles(cls, wn, t_sq, dipoles, energy=np.nan):
+        """Returns the spectrum of the transitions at the wave numbers wn
+        with the intensities t_sq and the signed transition dipoles as
+        (n_modes, 3) array. The polarized intensities are their squares.
+        """
+        data = np.empty((len(wn), len(cls.COLUMNS)), order="F")
+        data[:, 0] = wn
+        data[:, 1:4] = np.square(dipoles)
+        data[:, 4] = t_sq
+        data[:, 5:8] = dipoles
+        return cls(data, energy)
+
+    wn = _column(0, "Wave numbers of the transitions.")
+    x = _column(1, "x-polarized intensities.")
+    y = _column(2, "y-polarized intensities.")
+    z = _column(3, "z-polarized intensities.")
+    t_sq = _column(4, "Total intensities (T**2).")
+
+    @property
+    def dipoles(self):
+        """Signed transition dipoles (TX, TY, TZ) as (n_modes, 3) array.
+        """
+        return self.data[:, 5:8]
+
+    @property
+    def intensities(self):
+        """The x-, y-, z-polarized and total intensities as (4, n_modes)
+        array, as broadened by irras_angle.broaden_channels.
+        """
+        return self.data[:, 1:5].T
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return f"StickSpectrum({len(self)} modes, energy={self.energy})"
+
+
+class BroadenedSpectrum:
+    """The x-, y-, z-polarized and total spectra broadened onto the grid x as
+    (4, len(x)) array channels, see irras_angle.broaden_channels. All
+    channels are normalized by the maximum of the total spectrum so that
+    they keep their ratios. Both are only computed once, on first use.
+    """
+
+    TOTAL = 3
+    __slots__ = ("x", "channels", "_norm_factor", "_normalized")
+
+    def __init__(self, x, channels):
+        self.x = np.asarray(x)
+        self.channels = np.asarray(channels)
+        self._norm_factor = None
+        self._normalized = None
+
+    @property
+    def norm_factor(self):
+        if self._norm_factor is None:
+            self._norm_factor = np.amax(self.channels[self.TOTAL])
+        return self._norm_factor
+
+    @property
+    def normalized(self):
+        """The channels divided by norm_factor.
+        """
+        if self._normalized is None:
+            self._normalized = np.divide(self.channels, self.norm_factor)
+        return self._normalized
+
+    def __repr__(self):
+        return (f"BroadenedSpectrum({len(self.channels)} channels, "
+                f"{len(self.x)} points)")
+
+
+def spectrum_from_block(block, energy=np.nan, scalefactor=1):
+    """Returns the StickSpectrum of irras_angle.parse_outfile for an IR
+    spectrum block of an ORCA output given as bytes and the energy belonging
+    to it.
+    """
+    wavenumber, t_sq, tx, ty, tz = parse_ir_block(block)
+    return StickSpectrum.from_dipoles(np.multiply(wavenumber, scalefactor),
+                                      t_sq, np.column_stack([tx, ty, tz]),
+                                      energy)
+
+
+def parse_ir_block(block):
+    """Parses the rows of an IR spectrum block given as bytes. Only the lines
+    of the transitions (starting with the mode number and a colon) are picked
+    and converted to floats in one go. Returns the columns of the wave
+    numbers, T**2, TX, TY and TZ as arrays.
+    """
+    rows = IR_ROW_PATTERN.findall(block)
+    if not rows:
+        raise ValueError("Error! Invalid ORCA output file")
+    numbers = b" ".join(rows).translate(None, b"():").split()
+    try:
+        table = np.array(numbers, dtype=float).reshape(len(rows), -1)
+    except ValueError:
+        raise ValueError("Error! Invalid ORCA output file") from None
+    if table.shape[1] < 8:
+        raise ValueError("Error! Invalid ORCA output file")
+    return table[:, 1], table[:, 4], table[:, 5], table[:, 6], table[:, 7]
+
+
+def last_energy(buffer):
+    """Returns the last final single point energy in Hartree within buffer
+    (bytes or a memory map) or NaN if there is none.
+    """
+    start = buffer.rfind(ENERGY_LINE)
+    if start == -1:
+        return np.nan
+    start += len(ENERGY_LINE)
+    try:
+        return float(buffer[start:buffer.find(b"\n", start)])
+    except ValueError:
+        return np.nan
@@ -0,0 +1,120 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+# Files of a store directory: the spectra as one contiguous array without any
+# header and a small index describing it.
+DATA_FILE = "spectra.bin"
+INDEX_FILE = "index.json"
+# Part of the index. Must be increased whenever the layout changes.
+FORMAT_VERSION = 1
+
+
+class SpectrumStore:
+    """Broadened spectra sharing one grid stored in a directory. The spectra
+    are the rows of a C-ordered array in DATA_FILE which is memory-mapped on
+    first access, so that slicing single spectra or a range of wavenumbers
+    only reads the pages needed. The names, the grid and the parameters the
+    spectra were computed with are kept in INDEX_FILE.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        try:
+            with open(os.path.join(directory, INDEX_FILE), "r") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            sys.exit("Error! Spectrum store not found! Exiting ...")
+        except ValueError:
+            raise ValueError("Error! Invalid spectrum store") from None
+        try:
+            if index["version"] != FORMAT_VERSION:
+                raise KeyError("version")
+            self.names = index["names"]
+            self.x = np.array(index["x"], dtype=float)
+            self.dtype = np.dtype(index["dtype"])
+            self.params = index["params"]
+        except (KeyError, TypeError):
+            raise ValueError("Error! Invalid spectrum store") from None
+        self.rows = {name: row for row, name in enumerate(self.names)}
+        self._spectra = None
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def spectra(self):
+        """The (n_spectra, len(x)) read-only memory map of all spectra.
+        """
+        if self._spectra is None:
+            if not self.names:
+                return np.empty((0, len(self.x)), dtype=self.dtype)
+            self._spectra = np.memmap(os.path.join(self.directory, DATA_FILE),
+                                      dtype=self.dtype, mode="r",
+                                      shape=(len(self.names), len(self.x)))
+        return self._spectra
+
+    def columns(self, xmin=None, xmax=None):
+        """Returns the slice of grid points between xmin and xmax.
+        """
+        start = 0 if xmin is None else np.searchsorted(self.x, xmin, "left")
+        stop = len(self.x) if xmax is None else \
+            np.searchsorted(self.x, xmax, "right")
+        return slice(start, stop)
+
+    def spectrum(self, entry, xmin=None, xmax=None):
+        """Returns the grid and the spectrum entry (name or row number)
+        between xmin and xmax as arrays, reading only that part of the file.
+        """
+        row = self.rows[entry] if isinstance(entry, str) else entry
+        columns = self.columns(xmin, xmax)
+        return self.x[columns], np.array(self.spectra[row, columns])
+
+    @staticmethod
+    def create(directory, x, dtype=np.float32, **params):
+        """Creates an empty store and returns a StoreWriter appending spectra
+        to it. params are kept in the index, e.g. the linewidth.
+        """
+        os.makedirs(directory, exist_ok=True)
+        return StoreWriter(directory, x, np.dtype(dtype), params)
+
+
+class StoreWriter:
+    """Appends spectra to a store one at a time so that they never all have
+    to be in memory. The index is written on close(), which makes the store
+    readable.
+    """
+
+    def __init__(self, directory, x, dtype, params):
+        self.directory = directory
+        self.x = np.asarray(x, dtype=float)
+        self.dtype = dtype
+        self.params = params
+        self.names = []
+        self.file = open(os.path.join(directory, DATA_FILE), "wb")
+
+    def append(self, name, spectrum):
+        spectrum = np.asarray(spectrum, dtype=self.dtype)
+        if spectrum.shape != self.x.shape:
+            raise ValueError("Error! Spectrum does not match the grid of the "
+                             "store")
+        self.file.write(spectrum.tobytes())
+        self.names.append(name)
+
+    def close(self):
+        self.file.close()
+        index = {"version": FORMAT_VERSION, "dtype": self.dtype.str,
+                 "names": self.names, "x": self.x.tolist(),
+                 "params": self.params}
+        tmpname = os.path.join(self.directory, INDEX_FILE + ".tmp")
+        with open(tmpname, "w") as f:
+            json.dump(index, f)
+        os.replace(tmpname, os.path.join(self.directory, INDEX_FILE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
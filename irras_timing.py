@@ -0,0 +1,93 @@
+import contextlib
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+
+# Checked by stage() and count(). Everything is a no-op until enable() is
+# called, so the instrumented functions only pay for a function call.
+enabled = False
+_output = None
+_lock = threading.Lock()
+_totals = defaultdict(lambda: [0, 0.0])
+_counters = defaultdict(int)
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+def enable(path="-"):
+    """Switches timing on. Every finished stage is written as a JSON line to
+    path, with '-' meaning stderr.
+    """
+    global enabled, _output
+    disable()
+    _output = sys.stderr if path == "-" else open(path, "a")
+    enabled = True
+
+
+def disable():
+    """Writes the summary, closes the output and switches timing off.
+    """
+    global enabled, _output
+    if not enabled:
+        return
+    summary()
+    enabled = False
+    if _output is not sys.stderr:
+        _output.close()
+    _output = None
+    _totals.clear()
+    _counters.clear()
+
+
+def stage(name, **info):
+    """Returns a context manager timing the enclosed block as stage name.
+    info is added to the JSON line, e.g. the file or the number of points.
+    """
+    if not enabled:
+        return _NULL_CONTEXT
+    return _timed(name, info)
+
+
+@contextlib.contextmanager
+def _timed(name, info):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start, **info)
+
+
+def record(name, seconds, **info):
+    with _lock:
+        totals = _totals[name]
+        totals[0] += 1
+        totals[1] += seconds
+        _write({"stage": name, "seconds": seconds, **info})
+
+
+def count(name, n=1):
+    """Increases the counter name by n, e.g. for cache hits.
+    """
+    if enabled:
+        with _lock:
+            _counters[name] += n
+
+
+def summary():
+    """Writes the number of calls and the total time of all stages as well
+    as the counters as a single JSON line.
+    """
+    if not enabled:
+        return
+    with _lock:
+        _write({"summary": {name: {"calls": calls, "seconds": seconds}
+                            for name, (calls, seconds) in _totals.items()},
+                "counters": dict(_counters)})
+
+
+def _write(entry):
+    # Values such as numpy integers are written as strings rather than
+    # failing.
+    _output.write(json.dumps(entry, default=str) + "\n")
+    _output.flush()